@@ -0,0 +1,239 @@
+"""A local stand-in for the Assembla API, serving synthetic spaces
+
+Run it on its own to try it out:
+
+    python benchmarks/fake_assembla.py --tickets 12000 --latency 0.05
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+from collections import Counter, OrderedDict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+WORDS = (
+    'database error timeout login page crash slow export import report user '
+    'payment invoice search mail queue cache sync upload image api mobile'
+).split()
+
+
+class Space(object):
+    """A space with synthetic tickets and users"""
+
+    def __init__(self, space_id, tickets, users, seed=1):
+        rnd = random.Random(seed)
+        self.id = space_id
+        self.tickets = OrderedDict()
+        for number in range(1, tickets + 1):
+            self.add_ticket({
+                'summary': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 8))),
+                'description': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 200))),
+                'state': rnd.choice((0, 1, 1)),
+                'updated_at': '2017-%02d-%02dT%02d:00:00Z' % (
+                    rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23)
+                ),
+            })
+        self.users = [
+            {'id': 'u%d' % i, 'name': 'User %s %d' % (rnd.choice(WORDS).title(), i),
+             'login': 'user%d' % i, 'organization': None}
+            for i in range(users)
+        ]
+        self.associations = []
+        self.comments = []
+
+    def add_ticket(self, data):
+        number = len(self.tickets) + 1
+        ticket = dict({
+            'id': 1000000 + number,
+            'number': number,
+            'status': 'New',
+            'state': 1,
+            'priority': 3,
+            'hierarchy_type': 0,
+            'space_id': self.id,
+            'created_on': '2017-01-01T00:00:00Z',
+            'updated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'custom_fields': {'Team': 'Core', 'Estimate': '3'},
+        }, **data)
+        self.tickets[ticket['id']] = ticket
+        return ticket
+
+    def list_tickets(self, query):
+        tickets = list(self.tickets.values())
+        if query.get('report') == '1':
+            tickets = [t for t in tickets if t['state'] == 1]
+        if query.get('sort_by') == 'updated_at':
+            tickets.sort(key=lambda t: t['updated_at'], reverse=query.get('sort_order') == 'desc')
+
+        per_page = int(query.get('per_page', 10))
+        page = int(query.get('page', 1))
+        return tickets[(page - 1) * per_page:page * per_page]
+
+    def get_ticket(self, key, by_id):
+        for ticket in self.tickets.values():
+            if str(ticket['id' if by_id else 'number']) == key:
+                return ticket
+        return None
+
+
+class FakeAssembla(ThreadingMixIn, HTTPServer):
+    """Serves /v1 of the Assembla API for a few spaces, adding latency and
+    throttling (429 responses) to a share of the requests"""
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), spaces=None, latency=0.0,
+                 throttle=0.0, retry_after=1):
+        HTTPServer.__init__(self, address, Handler)
+        self.spaces = dict((s.id, s) for s in spaces or [])
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%s/v1' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests.clear()
+            self.bytes_sent = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+    routes = (
+        ('GET', r'^/v1/spaces\.json$', 'spaces'),
+        ('GET', r'^/v1/spaces/([^/]+)/tickets\.json$', 'tickets'),
+        ('GET', r'^/v1/spaces/([^/]+)/tickets/id/([^/.]+)', 'ticket_by_id'),
+        ('GET', r'^/v1/spaces/([^/]+)/tickets/([^/.]+)', 'ticket_by_number'),
+        ('GET', r'^/v1/spaces/([^/]+)/users\.json$', 'users'),
+        ('POST', r'^/v1/spaces/([^/]+)/tickets$', 'create_ticket'),
+        ('POST', r'^/v1/spaces/([^/]+)/tickets/([^/]+)/ticket_comments$', 'create_comment'),
+        ('POST', r'^/v1/spaces/([^/]+)/tickets/([^/]+)/ticket_associations$', 'create_association'),
+    )
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+        for route_method, pattern, name in self.routes:
+            match = re.match(pattern, url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.reply(404, {'error': 'Not found'})
+
+        with server.lock:
+            server.requests[name] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.throttle and random.random() < server.throttle:
+            return self.reply(429, {'error': 'Too many requests'}, {'Retry-After': str(server.retry_after)})
+
+        args = match.groups()
+        space = server.spaces.get(args[0]) if args else None
+        if args and space is None:
+            return self.reply(404, {'error': 'Space not found'})
+
+        body = None
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+
+        getattr(self, name)(space, query, body, *args[1:])
+
+    def reply(self, status, data=None, headers=None):
+        payload = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        with self.server.lock:
+            self.server.bytes_sent += len(payload)
+
+    def spaces(self, space, query, body):
+        self.reply(200, [{'id': s.id, 'name': s.id.title()} for s in self.server.spaces.values()])
+
+    def tickets(self, space, query, body):
+        tickets = space.list_tickets(query)
+        self.reply(200 if tickets else 204, tickets or None)
+
+    def ticket_by_id(self, space, query, body, key):
+        ticket = space.get_ticket(key, by_id=True)
+        self.reply(200 if ticket else 404, ticket or {'error': 'Not found'})
+
+    def ticket_by_number(self, space, query, body, key):
+        ticket = space.get_ticket(key, by_id=False)
+        self.reply(200 if ticket else 404, ticket or {'error': 'Not found'})
+
+    def users(self, space, query, body):
+        self.reply(200, space.users)
+
+    def create_ticket(self, space, query, body):
+        self.reply(201, space.add_ticket(body['ticket']))
+
+    def create_comment(self, space, query, body, number):
+        space.comments.append((number, body))
+        self.reply(201, {'id': len(space.comments), 'comment': body['ticket_comment']['comment']})
+
+    def create_association(self, space, query, body, number):
+        space.associations.append(body)
+        self.reply(201, dict(body, id=len(space.associations)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--spaces', type=int, default=1)
+    parser.add_argument('--tickets', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--throttle', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeAssembla(
+        ('127.0.0.1', args.port),
+        spaces=[Space('space%d' % i, args.tickets, args.users, seed=i) for i in range(args.spaces)],
+        latency=args.latency,
+        throttle=args.throttle,
+    )
+    print('Serving %s' % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
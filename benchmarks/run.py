@@ -0,0 +1,222 @@
+"""Runs scripted workloads through AssemblaClient and AssemblaPlugin against
+a local stand-in for the Assembla API (see fake_assembla.py), reporting the
+p50/p99 latency, the API requests made and the peak memory of each workload
+
+Requires a configured Sentry (SENTRY_CONF) with this plugin installed:
+
+    python benchmarks/run.py --tickets 12000 --latency 0.05 --throttle 0.01
+    python benchmarks/run.py --setting ASSEMBLA_CONCURRENCY=16
+"""
+from __future__ import absolute_import, print_function
+
+from sentry.runner import configure
+configure()
+
+import argparse
+import ast
+import gc
+import json
+import resource
+import sys
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from sentry_assembla.client import AssemblaClient
+from sentry_assembla.index import TicketIndex
+from sentry_assembla.plugin import AssemblaPlugin
+
+from fake_assembla import FakeAssembla, Space, WORDS
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Stub(object):
+    """A request, user, group or project, with only what the plugin uses"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeAuth(object):
+    """An Assembla identity, which is never refreshed"""
+    provider = 'assembla'
+
+    def __init__(self, id):
+        self.id = id
+        self.user_id = id
+        self.extra_data = {'access_token': 'token', 'refresh_token': 'refresh'}
+
+    @property
+    def tokens(self):
+        return self.extra_data
+
+    def save(self):
+        pass
+
+
+class BenchmarkPlugin(AssemblaPlugin):
+    """The plugin, with its options and identities kept in memory"""
+    options = {}
+    auth = None
+    # the stored tickets by group, instead of GroupMeta
+    tickets = {}
+
+    def get_option(self, key, project=None, user=None):
+        return self.options.get(key)
+
+    def get_auth_for_user(self, user, **kwargs):
+        return self.auth
+
+    def store_ticket(self, group, space, issue):
+        self.tickets[group.id] = dict(issue, space=space)
+
+    def get_ticket(self, group, issue_id):
+        return self.tickets.get(group.id)
+
+
+def reset_caches(spaces):
+    for space in spaces:
+        cache.delete('assembla:ticket-index:%s' % space)
+    for local in (AssemblaClient.users, TicketIndex.search_indexes,
+                  AssemblaPlugin.autocomplete_results, AssemblaPlugin.clients,
+                  AssemblaPlugin.spaces, AssemblaPlugin.parent_issues):
+        local.entries.clear()
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[int(round(p * (len(timings) - 1)))]
+
+
+def measure(name, server, calls, before=None):
+    """Run every call, returning a report of the workload"""
+    server.reset_counts()
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    timings = []
+    for call in calls:
+        if before is not None:
+            before()
+        start = time.time()
+        call()
+        timings.append(time.time() - start)
+
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024
+        tracemalloc.stop()
+    else:
+        # the peak of the process so far, in kB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    return {
+        'workload': name,
+        'calls': len(timings),
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'requests': sum(server.requests.values()),
+        'requests_by_endpoint': dict(server.requests),
+        'bytes': server.bytes_sent,
+        'peak_mb': peak,
+    }
+
+
+def typed(words):
+    """Every prefix of every word, as typed in an autocomplete field"""
+    return [word[:end] for word in words for end in range(1, len(word) + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per request')
+    parser.add_argument('--throttle', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--setting', action='append', default=[], help='NAME=VALUE, overrides a setting')
+    parser.add_argument('--json', help='write the reports to this file')
+    args = parser.parse_args()
+
+    for override in args.setting:
+        name, value = override.split('=', 1)
+        setattr(settings, name, ast.literal_eval(value))
+
+    space = 'space0'
+    server = FakeAssembla(
+        spaces=[Space(space, args.tickets, args.users)],
+        latency=args.latency,
+        throttle=args.throttle,
+    ).start()
+    AssemblaClient.base_url = server.url
+    AssemblaClient.per_page = args.page_size
+    # measure the search itself, without a worker building the index
+    AssemblaClient.build_in_background = lambda self, space: None
+
+    auth = FakeAuth(1)
+    client = AssemblaClient(auth=auth)
+    plugin = BenchmarkPlugin()
+    plugin.auth = auth
+    plugin.options = {'space': space, 'parent_issue_number': '1', 'relationship': '6'}
+
+    project = Stub(id=1)
+    group = Stub(id=1, project=project, project_id=1)
+    user = Stub(id=1)
+    queries = ['data', 'login error', 'er', 'export report', 'zzz'] * args.iterations
+    reset = lambda: reset_caches([space])
+
+    def autocomplete(field, query):
+        request = Stub(user=user, GET={'autocomplete_field': field, 'autocomplete_query': query})
+        return lambda: plugin.view_autocomplete(request, group)
+
+    def create_issue(n):
+        form_data = {'title': 'Benchmark %d' % n, 'description': '...', 'parent_issue_id': '1000001'}
+        return lambda: plugin.create_issue(Stub(user=user), group, form_data)
+
+    def link_issue(n):
+        form_data = {'issue_id': str(1000001 + n), 'comment': 'Linked by a benchmark'}
+        return lambda: plugin.link_issue(Stub(user=user), group, form_data)
+
+    reset()
+    reports = [
+        measure('search_tickets (cold)', server,
+                [lambda q=q: client.search_tickets(space, q, limit=50) for q in queries], before=reset),
+        measure('search_tickets (cold, full index)', server,
+                [lambda q=q: client.search_tickets(space, q) for q in queries], before=reset),
+        measure('search_tickets (warm)', server,
+                [lambda q=q: client.search_tickets(space, q, limit=50) for q in queries]),
+        measure('search_users', server,
+                [lambda q=q: client.search_users(space, q, limit=50) for q in queries]),
+        measure('view_autocomplete issue_id (typing)', server,
+                [autocomplete('issue_id', q) for q in typed(WORDS[:args.iterations])]),
+        measure('view_autocomplete assignee (typing)', server,
+                [autocomplete('assignee', q) for q in typed(['user 1', 'login'])]),
+        measure('create_issue (with parent)', server,
+                [create_issue(n) for n in range(args.iterations * 4)]),
+        measure('link_issue (with comment)', server,
+                [link_issue(n) for n in range(args.iterations * 4)]),
+    ]
+
+    print('%-45s %6s %10s %10s %9s %10s %9s' % (
+        'workload', 'calls', 'p50 ms', 'p99 ms', 'requests', 'kB', 'peak MB'))
+    for r in reports:
+        print('%-45s %6d %10.1f %10.1f %9d %10.0f %9.1f' % (
+            r['workload'], r['calls'], r['p50_ms'], r['p99_ms'], r['requests'],
+            r['bytes'] / 1024.0, r['peak_mb']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""An asyncio based Assembla client, exposing the same methods as
+AssemblaClient. Requires Python 3 and aiohttp, and is left out when 
+installing on Python 2
+
+Concurrent calls, like the pages of a listing or the parent ticket of a new
+ticket, are made on a single thread. AssemblaClientBridge lets synchronous
+code, like the plugin, use it. Every worker process runs one event loop, on
+a thread of its own, with one session, so connections are reused
+
+The cached tickets and users are shared with AssemblaClient. Only the index
+of the cached tickets is still searched on a thread, as TicketIndex and its
+syncs are synchronous"""
+from __future__ import absolute_import
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import aiohttp
+
+from social_auth.utils import setting
+from sentry_plugins.exceptions import ApiError, ApiHostError, ApiUnauthorized
+
+from . import filters, metrics
+from .client import AssemblaClient, SearchCancelled
+from .index import Ticket, TicketIndex
+from .scheduler import INTERACTIVE, Throttled, get_scheduler
+from .search import SearchIndex, combine
+from .tokens import refresh
+
+_lock = threading.Lock()
+_runner = {}
+
+
+def get_runner():
+    """Get the event loop and session of this process, starting them when
+    needed, again after a fork"""
+    with _lock:
+        if _runner.get('pid') != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='assembla-aio')
+            thread.daemon = True
+            thread.start()
+
+            async def create_session():
+                return aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                    limit=setting('ASSEMBLA_POOL_SIZE', 10),
+                ))
+
+            session = asyncio.run_coroutine_threadsafe(create_session(), loop).result()
+            _runner.update(pid=os.getpid(), loop=loop, session=session)
+        return _runner['loop'], _runner['session']
+
+
+class AsyncAssemblaClient(object):
+    base_url = AssemblaClient.base_url
+    per_page = AssemblaClient.per_page
+
+    def __init__(self, session, auth=None, priority=INTERACTIVE):
+        self.session = session
+        self.auth = auth
+        self.priority = priority
+
+    async def request(self, method, path, params=None, data=None):
+        """Send a request using the access token, refreshing the token and 
+        retrying once when it has expired"""
+        try:
+            return await self.send(method, path, params, data)
+        except ApiUnauthorized:
+            if not self.auth:
+                raise
+
+        await asyncio.get_event_loop().run_in_executor(None, refresh, self.auth)
+        return await self.send(method, path, params, data)
+
+    async def send(self, method, path, params=None, data=None):
+        """Send a request when the scheduler of this identity allows it,
+        retrying throttled and failed requests, like AssemblaClient.send"""
+        headers = {'Accept': 'application/json'}
+        if self.auth:
+            headers['Authorization'] = 'Bearer %s' % self.auth.tokens['access_token']
+
+        loop = asyncio.get_event_loop()
+        tags = {'endpoint': metrics.endpoint(path), 'method': method}
+        scheduler = get_scheduler(self.auth.id if self.auth else None)
+        attempt = 0
+        while True:
+            if scheduler is not None:
+                try:
+                    await loop.run_in_executor(None, scheduler.acquire, self.priority)
+                except Throttled as e:
+                    metrics.incr('api.throttled', tags=tags)
+                    raise ApiError(str(e), code=429)
+
+            start = time.time()
+            try:
+                async with self.session.request(
+                    method, self.base_url + path, params=params, json=data, headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=setting('ASSEMBLA_TIMEOUT', 30)),
+                ) as response:
+                    metrics.timing('api.request', time.time() - start, tags=dict(tags, status=response.status))
+                    if response.status < 400:
+                        body = await response.read()
+                        metrics.incr('api.bytes', amount=len(body), tags=tags)
+                        if response.status == 204 or not body:
+                            return {}
+                        return json.loads(body.decode('utf-8'))
+
+                    status = response.status
+                    delay = scheduler and scheduler.retry_delay(
+                        status, response.headers, attempt, idempotent=method == 'GET',
+                    )
+                    if delay is None:
+                        if status == 401:
+                            raise ApiUnauthorized(await response.text())
+                        raise ApiError(await response.text(), code=status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                metrics.incr('api.connection_error', tags=tags)
+                raise ApiHostError.from_exception(e)
+
+            metrics.incr('api.retry', tags=dict(tags, status=status))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, path, params=None):
+        return await self.request('GET', path, params=params)
+
+    async def post(self, path, data=None):
+        return await self.request('POST', path, data=data)
+
+    async def iter_batches(self, path, params=None):
+        """Retrieve the pages of a listing in concurrent batches, see 
+        AssemblaClient.iter_batches"""
+        params = dict(params or {}, per_page=self.per_page)
+
+        def fetch(page):
+            return self.get(path, params=dict(params, page=page))
+
+        first = await fetch(1)
+        yield [first]
+        if len(first) < self.per_page:
+            return
+
+        concurrency = max(1, int(setting('ASSEMBLA_CONCURRENCY', 8)))
+        page = 2
+        while True:
+            batch = await asyncio.gather(*[fetch(p) for p in range(page, page + concurrency)])
+            yield batch
+            if any(len(response) < self.per_page for response in batch):
+                return
+            page += concurrency
+
+    async def get_spaces(self):
+        """Get all spaces available to this user"""
+        return await self.get('/spaces.json')
+
+    async def get_issue(self, space, issue_id):
+        """Try and get a ticket bij ticket id"""
+        if isinstance(issue_id, str) and len(issue_id) == 0:
+            return None
+        return await self.get('/spaces/%s/tickets/id/%s' % (space, issue_id))
+
+    async def get_issue_by_number(self, space, issue_number):
+        """Try and get a ticket bij ticket number"""
+        if isinstance(issue_number, str) and len(issue_number) == 0:
+            return None
+        return await self.get('/spaces/%s/tickets/%s' % (space, issue_number))
+
+    async def create_issue(self, space, data, associate=True):
+        """Create a ticket, retrieving the parent ticket at the same time"""
+        assembla_data = {'summary': data['title'], 'description': data['description'], 'space_id': space}
+
+        if data.get('parent_issue_id'):
+            assembla_data['hierarchy_type'] = 1 #1 = Sub-task
+
+        if data.get('assignee'):
+            assembla_data['assigned_to_id'] = data['assignee']
+
+        if not (associate and data.get('parent_issue_id')):
+            return await self.post('/spaces/%s/tickets' % space, data={'ticket': assembla_data})
+
+        new_ticket, parent_issue = await asyncio.gather(
+            self.post('/spaces/%s/tickets' % space, data={'ticket': assembla_data}),
+            self.get_issue(space, data['parent_issue_id']),
+        )
+        await self.associate(space, parent_issue, new_ticket, data.get('relationship'))
+        return new_ticket
+
+    async def associate(self, space, parent_issue, issue, relationship=None):
+        """Associate a ticket with its parent ticket"""
+        return await self.post(
+            '/spaces/%s/tickets/%s/ticket_associations' % (space, parent_issue['number']),
+            data={'ticket1_id': parent_issue['id'],
+                  'ticket2_id': issue['id'],
+                  'relationship': relationship or 1}
+        )
+
+    async def create_comment(self, space, issue, comment):
+        """Create a comment on a ticket with the posted data"""
+        return await self.post(
+            '/spaces/%s/tickets/%s/ticket_comments' % (space, issue['number']),
+            data={'ticket_comment': {'comment': comment}},
+        )
+
+    async def search_tickets(self, space, query, type='parent', limit=None, cancelled=None):
+        """Search the tickets of a space, see AssemblaClient.search_tickets
+        Until the index of the space is built, by a worker, the reports in
+        ASSEMBLA_SEARCH_REPORTS and then all tickets are scanned, in batches
+        of concurrent requests, until the limit is met"""
+        start = time.time()
+        loop = asyncio.get_event_loop()
+        client = AssemblaClient(auth=self.auth, priority=self.priority)
+        index = TicketIndex(client, space)
+        parent_filter = type == 'parent' and filters.parent_ticket_filter()
+        try:
+            if limit and not await loop.run_in_executor(None, index.is_built):
+                await loop.run_in_executor(None, client.build_in_background, space)
+                return await self.scan_tickets(
+                    space, query, limit, combine(filters.ticket_filter(), parent_filter), cancelled
+                )
+
+            search_index = await loop.run_in_executor(None, index.get_search_index)
+            return search_index.search(query, limit, parent_filter or None)
+        finally:
+            metrics.timing('search_tickets', time.time() - start)
+
+    async def scan_tickets(self, space, query, limit, predicate=None, cancelled=None):
+        """Search the reports, then all tickets, most recently updated first"""
+        path = '/spaces/%s/tickets.json' % space
+        fields = ('number', 'summary')
+        matches = OrderedDict()
+        listings = [
+            ({'report': report}, setting('ASSEMBLA_SEARCH_REPORT_PAGES', 5))
+            for report in setting('ASSEMBLA_SEARCH_REPORTS', [1])
+        ] + [({}, None)]
+
+        for params, max_pages in listings:
+            pages = 0
+            params = dict(params, sort_by='updated_at', sort_order='desc')
+            batches = self.iter_batches(path, params)
+            try:
+                async for batch in batches:
+                    for page in batch:
+                        pages += 1
+                        candidates = filters.apply(predicate, [Ticket(item) for item in page])
+                        matches.update((t.id, t) for t in SearchIndex(candidates, fields).search(query))
+                    if len(matches) >= limit or (max_pages and pages >= max_pages):
+                        break
+                    if cancelled is not None and cancelled():
+                        raise SearchCancelled()
+            finally:
+                await batches.aclose()
+
+            metrics.timing('search_tickets.pages', pages, tags={
+                'source': 'report' if 'report' in params else 'scan'
+            })
+            if len(matches) >= limit:
+                break
+
+        return SearchIndex(matches.values(), fields).search(query, limit)
+
+    async def search_users(self, space, query, limit=None):
+        """Search the users of a space, sharing the cached users with
+        AssemblaClient"""
+        start = time.time()
+        try:
+            index = AssemblaClient.users.get(space)
+            if index is None:
+                users = await self.get('/spaces/%s/users.json' % space)
+                index = SearchIndex(filters.apply(filters.users_filter(), users), ('name', 'login'))
+                AssemblaClient.users.set(space, index)
+            return index.search(query, limit)
+        finally:
+            metrics.timing('search_users', time.time() - start)
+
+
+class AssemblaClientBridge(object):
+    """Makes the methods of AsyncAssemblaClient blocking calls, run on the
+    event loop of this process"""
+
+    def __init__(self, auth=None, priority=INTERACTIVE):
+        self.auth = auth
+        self.priority = priority
+
+    def __getattr__(self, name):
+        if not asyncio.iscoroutinefunction(getattr(AsyncAssemblaClient, name, None)):
+            raise AttributeError(name)
+
+        def run(*args, **kwargs):
+            loop, session = get_runner()
+            client = AsyncAssemblaClient(session, auth=self.auth, priority=self.priority)
+            return asyncio.run_coroutine_threadsafe(
+                getattr(client, name)(*args, **kwargs), loop
+            ).result()
+
+        return run
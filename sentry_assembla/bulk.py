@@ -0,0 +1,47 @@
+"""Run many Assembla API calls at once, within a rate limit"""
+from __future__ import absolute_import
+
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+
+class RateLimit(object):
+    """Allows at most `rate` calls to start per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_concurrently(func, items, concurrency=4, rate=None):
+    """Call func for every item on a bounded pool of threads
+    Returns a (result, error) tuple for every item, in the same order"""
+    limit = RateLimit(rate)
+
+    def call(item):
+        limit.wait()
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    if not items:
+        return []
+
+    pool = ThreadPool(max(1, min(concurrency, len(items))))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
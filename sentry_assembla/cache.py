@@ -0,0 +1,144 @@
+"""A small cache for Assembla API results"""
+from __future__ import absolute_import
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from social_auth.utils import setting
+
+from . import metrics
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+
+MISSING = object()
+
+
+class Flight(object):
+    """A load in progress, other callers wait for its result"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Cache(object):
+    """A process-local LRU cache with a time to live per entry
+    Concurrent loads of a missing key are coalesced, only the first caller
+    runs the loader. When ASSEMBLA_CACHE_BACKEND names a Django cache,
+    shared entries are stored there as well, so workers share them. Local
+    copies of shared entries are then only kept ASSEMBLA_LOCAL_CACHE_TTL
+    seconds, so changes and deletes of other workers are seen soon.
+    The time to live can be set with ASSEMBLA_<NAME>_CACHE_TTL"""
+
+    def __init__(self, name, max_size=100, ttl=5 * 60, shared=True):
+        self.name = name
+        self.max_size = max_size
+        self.default_ttl = ttl
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return setting('ASSEMBLA_%s_CACHE_TTL' % self.name.upper().replace('-', '_'), self.default_ttl)
+
+    @property
+    def backend(self):
+        alias = setting('ASSEMBLA_CACHE_BACKEND')
+        if not self.shared or not alias:
+            return None
+        return get_cache(alias)
+
+    def local_ttl(self, ttl, backend):
+        if backend is None:
+            return ttl
+        return min(ttl, setting('ASSEMBLA_LOCAL_CACHE_TTL', 5))
+
+    def make_key(self, key):
+        if isinstance(key, tuple):
+            key = ':'.join(str(k) for k in key)
+        return 'assembla:%s:%s' % (self.name, key)
+
+    def get(self, key, default=None):
+        """Get an entry, from the shared cache if it isn't available locally"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.entries[key] = self.entries.pop(key)
+                    metrics.incr('cache.hit', tags={'cache': self.name, 'backend': 'local'})
+                    return entry[1]
+                del self.entries[key]
+
+        backend = self.backend
+        if backend is not None:
+            value = backend.get(self.make_key(key), MISSING)
+            if value is not MISSING:
+                self.store(key, value, self.local_ttl(self.ttl, backend))
+                metrics.incr('cache.hit', tags={'cache': self.name, 'backend': 'shared'})
+                return value
+
+        metrics.incr('cache.miss', tags={'cache': self.name})
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        backend = self.backend
+        self.store(key, value, self.local_ttl(ttl, backend))
+        if backend is not None:
+            backend.set(self.make_key(key), value, ttl)
+
+    def store(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        backend = self.backend
+        if backend is not None:
+            backend.delete(self.make_key(key))
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Get an entry, calling loader to create it when it is missing"""
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            self.set(key, flight.value, ttl)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
@@ -1,11 +1,193 @@
 from __future__ import absolute_import
 
+import six
+import time
+
+from collections import OrderedDict
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache import cache
+from requests.exceptions import ConnectionError, HTTPError
 from social_auth.utils import setting
-from sentry_plugins.client import AuthApiClient
+from sentry_plugins.client import AuthApiClient, BaseApiResponse
+from sentry_plugins.exceptions import ApiError, ApiHostError, ApiUnauthorized
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from . import filters, metrics
+from .cache import Cache
+from .index import Ticket, TicketIndex
+from .scheduler import INTERACTIVE, Throttled, get_scheduler
+from .search import SearchIndex, combine
+from .session import get_session
+from .tokens import refresh
+
+class SearchCancelled(Exception):
+    """The search was cancelled before it was done"""
+
 
 class AssemblaClient(AuthApiClient):
     base_url = u'https://api.assembla.com/v1'
-    users = {}
+    users = Cache('users', max_size=100, ttl=60 * 60)
+    per_page = 100
+
+    def __init__(self, auth=None, priority=INTERACTIVE, *args, **kwargs):
+        self.priority = priority
+        super(AssemblaClient, self).__init__(auth, *args, **kwargs)
+
+    def _request(self, method, path, **kwargs):
+        """Send a request using the access token, refreshing the token and 
+        retrying once when it has expired"""
+        headers = kwargs.setdefault('headers', {})
+        headers.setdefault('Accept', 'application/json, application/xml')
+        if self.auth and 'Authorization' not in headers:
+            headers['Authorization'] = 'Bearer %s' % self.auth.tokens['access_token']
+
+        try:
+            return self.send(method, path, **kwargs)
+        except ApiUnauthorized:
+            if not self.auth:
+                raise
+
+        refresh(self.auth)
+        headers['Authorization'] = 'Bearer %s' % self.auth.tokens['access_token']
+        return self.send(method, path, **kwargs)
+
+    def send(self, method, path, headers=None, data=None, params=None,
+             auth=None, json=True, allow_text=False, allow_redirects=None,
+             stream=False):
+        """Send a request through the pooled session, when the scheduler of
+        this identity allows it, retrying throttled and failed requests
+        With stream=True the unread response is returned"""
+        if allow_redirects is None:
+            allow_redirects = method.upper() == 'GET'
+
+        scheduler = get_scheduler(self.auth.id if self.auth else None)
+        tags = {'endpoint': metrics.endpoint(path), 'method': method.upper()}
+        attempt = 0
+        while True:
+            if scheduler is not None:
+                try:
+                    scheduler.acquire(self.priority)
+                except Throttled as e:
+                    metrics.incr('api.throttled', tags=tags)
+                    raise ApiError(six.text_type(e), code=429)
+
+            start = time.time()
+            try:
+                response = get_session().request(
+                    method,
+                    self.build_url(path),
+                    headers=headers,
+                    json=data if json else None,
+                    data=data if not json else None,
+                    params=params,
+                    auth=auth,
+                    verify=self.verify_ssl,
+                    allow_redirects=allow_redirects,
+                    timeout=setting('ASSEMBLA_TIMEOUT', 30),
+                    stream=stream,
+                )
+                metrics.timing('api.request', time.time() - start, tags=dict(
+                    tags, status=response.status_code
+                ))
+                response.raise_for_status()
+            except ConnectionError as e:
+                metrics.incr('api.connection_error', tags=tags)
+                raise ApiHostError.from_exception(e)
+            except HTTPError as e:
+                delay = scheduler and scheduler.retry_delay(
+                    e.response.status_code, e.response.headers, attempt,
+                    idempotent=method.upper() == 'GET',
+                )
+                if delay is None:
+                    error = ApiError.from_response(e.response)
+                    e.response.close()
+                    raise error
+                # release the connection of a streamed response
+                e.response.close()
+                metrics.incr('api.retry', tags=dict(tags, status=e.response.status_code))
+                time.sleep(delay)
+                attempt += 1
+            else:
+                break
+
+        if stream:
+            return response
+        metrics.incr('api.bytes', amount=len(response.content), tags=tags)
+        if response.status_code == 204:
+            return {}
+        return BaseApiResponse.from_response(response, allow_text=allow_text)
+
+    def get_items(self, path, params=None, project=None):
+        """Retrieve a listing, decoding it one item at a time when ijson is
+        installed, and only keeping what project returns for each item"""
+        project = project or (lambda item: item)
+        response = self.get(path, params=params, stream=True)
+        try:
+            if response.status_code == 204:
+                return []
+            if ijson is None:
+                return [project(item) for item in response.json()]
+
+            response.raw.decode_content = True
+            return [project(item) for item in ijson.items(response.raw, 'item')]
+        finally:
+            metrics.incr('api.bytes', amount=response.raw.tell(), tags={
+                'endpoint': metrics.endpoint(path), 'method': 'GET'
+            })
+            response.close()
+
+    def get_pages(self, path, params=None, project=None):
+        """Retrieve every page of a listing"""
+        pages = list(chain.from_iterable(self.iter_batches(path, params, project)))
+        metrics.timing('listing.pages', len(pages), tags={'endpoint': metrics.endpoint(path)})
+        return list(chain.from_iterable(pages))
+
+    def iter_batches(self, path, params=None, project=None):
+        """Retrieve the pages of a listing in batches
+        Assembla doesn't report the number of pages, so the first page is used
+        as a probe, the following pages are fetched in concurrent batches until
+        a short (last) page comes back. The next batch is only retrieved when
+        the caller asks for it"""
+        params = dict(params or {}, per_page=self.per_page)
+
+        def fetch(page):
+            return self.get_items(path, dict(params, page=page), project)
+
+        first = fetch(1)
+        yield [first]
+        if len(first) < self.per_page:
+            return
+
+        concurrency = max(1, int(setting('ASSEMBLA_CONCURRENCY', 8)))
+        pool = ThreadPool(concurrency)
+        try:
+            page = 2
+            while True:
+                batch = pool.map(fetch, range(page, page + concurrency))
+                yield batch
+                if any(len(response) < self.per_page for response in batch):
+                    return
+                page += concurrency
+        finally:
+            pool.close()
+            pool.join()
+
+    def iter_pages(self, path, params=None, project=None):
+        """Retrieve the pages of a listing one at a time"""
+        params = dict(params or {}, per_page=self.per_page)
+        page = 1
+        while True:
+            response = self.get_items(path, dict(params, page=page), project)
+            yield response
+            if len(response) < self.per_page:
+                return
+            page += 1
 
     def get_spaces(self):
         """Get all spaces available to this user"""
@@ -13,20 +195,22 @@ class AssemblaClient(AuthApiClient):
 
     def get_issue(self, space, issue_id):
         """Try and get a ticket bij ticket id"""
-        if isinstance(issue_id, basestring) and len(issue_id) == 0:
+        if isinstance(issue_id, six.string_types) and len(issue_id) == 0:
             return None
         
         return self.get('/spaces/%s/tickets/id/%s' % (space, issue_id))
 
     def get_issue_by_number(self, space, issue_number):
         """Try and get a ticket bij ticket number"""
-        if isinstance(issue_number, basestring) and len(issue_number) == 0:
+        if isinstance(issue_number, six.string_types) and len(issue_number) == 0:
             return None
         
         return self.get('/spaces/%s/tickets/%s' % (space, issue_number))
 
-    def create_issue(self, space, data):
-        """Create a ticket with the posted data, using the api"""
+    def create_issue(self, space, data, associate=True):
+        """Create a ticket with the posted data, using the api
+        The parent ticket is retrieved while the ticket is being created. 
+        Pass associate=False to leave the association to the caller"""
         assembla_data = {'summary': data['title'], 'description': data['description'], 'space_id': space}
         
         if data.get('parent_issue_id'):
@@ -35,25 +219,33 @@ class AssemblaClient(AuthApiClient):
         if data.get('assignee'):
             assembla_data['assigned_to_id'] = data['assignee']
 
-        new_ticket = self.post('/spaces/%s/tickets' % space, data={'ticket': assembla_data})
-        
-        if data.get('parent_issue_id'):
-            parent_issue = self.get_issue(space, data['parent_issue_id'])
-
-            #1: Parent - Child
-            #6: Story - Sub-Task
-            relationship = 1
-            if data.get('relationship'):
-                relationship = data['relationship']
-            
-            self.post('/spaces/%s/tickets/%s/ticket_associations' % (space, parent_issue['number']), 
-                data={'ticket1_id': parent_issue['id'],
-                    'ticket2_id': new_ticket['id'],
-                    'relationship': relationship}
-            )
+        pool = None
+        if associate and data.get('parent_issue_id'):
+            pool = ThreadPool(1)
+            parent_issue = pool.apply_async(self.get_issue, (space, data['parent_issue_id']))
+            pool.close()
+
+        try:
+            new_ticket = self.post('/spaces/%s/tickets' % space, data={'ticket': assembla_data})
+
+            if pool is not None:
+                self.associate(space, parent_issue.get(), new_ticket, data.get('relationship'))
+        finally:
+            if pool is not None:
+                pool.join()
         
         return new_ticket
 
+    def associate(self, space, parent_issue, issue, relationship=None):
+        """Associate a ticket with its parent ticket"""
+        #1: Parent - Child
+        #6: Story - Sub-Task
+        return self.post('/spaces/%s/tickets/%s/ticket_associations' % (space, parent_issue['number']), 
+            data={'ticket1_id': parent_issue['id'],
+                'ticket2_id': issue['id'],
+                'relationship': relationship or 1}
+        )
+
     def create_comment(self, space, issue, comment):
         """Create a comment on a ticket with the posted data"""
         return self.post(
@@ -61,47 +253,123 @@ class AssemblaClient(AuthApiClient):
             data={'ticket_comment': {'comment': comment}},
         )
 
-    def search_tickets(self, space, query, type='parent', page=1):
+    @metrics.timed('search_tickets')
+    def search_tickets(self, space, query, type='parent', limit=None, cancelled=None):
         """Search a ticket by the passed query
-        Assembla sadly doesn't allow for searching, we thus have to 
-        retrieve all pages to get a full result"""
-        response = self.get(
-            '/spaces/%s/tickets.json' % space,
-            params={'page': page, 'per_page': 100, }
-        )
-        query = query.lower()
+        Assembla sadly doesn't allow for searching, we thus search a local
+        index of the tickets in the space. Until that index is built, the
+        reports in ASSEMBLA_SEARCH_REPORTS are searched first, then all
+        tickets in concurrent batches, stopping as soon as the limit is met,
+        or when cancelled() returns True. Only a worker builds the index, the
+        scan doesn't store what it read.
+        The index only holds tickets passing ASSEMBLA_TICKET_FILTER"""
+        parent_filter = type == 'parent' and filters.parent_ticket_filter()
+        predicate = combine(filters.ticket_filter(), parent_filter)
+        index = TicketIndex(self, space)
 
-        filtered = [e for e in response if query in e['summary'].lower()]
-        
-        if setting('ASSEMBLA_TICKET_FILTER'):
-            filtered = filter(setting('ASSEMBLA_TICKET_FILTER'), filtered)
-        
-        if type == 'parent' and setting('ASSEMBLA_PARENTTICKET_FILTER'):
-            filtered = filter(setting('ASSEMBLA_PARENTTICKET_FILTER'), filtered)
-        
-        if len(response) >= 100:
-            page += 1
-            filtered += self.search_tickets(space, query, type, page)
-        
-        return filtered
+        if limit and not index.is_built():
+            self.build_in_background(space)
+            results = self.search_reports(space, query, limit, predicate, cancelled)
+            if len(results) >= limit:
+                return results
+
+            pages = 0
+            matches = OrderedDict()
+            params = {'sort_by': 'updated_at', 'sort_order': 'desc'}
+            batches = self.iter_batches('/spaces/%s/tickets.json' % space, params, project=Ticket)
+            for batch in batches:
+                pages += len(batch)
+                for page in batch:
+                    candidates = filters.apply(predicate, page)
+                    matches.update(
+                        (t.id, t) for t in SearchIndex(candidates, ('number', 'summary')).search(query)
+                    )
+                if len(matches) >= limit:
+                    batches.close()
+                    break
+                if cancelled is not None and cancelled():
+                    batches.close()
+                    raise SearchCancelled()
+
+            metrics.timing('search_tickets.pages', pages, tags={'source': 'scan'})
+            return SearchIndex(matches.values(), ('number', 'summary')).search(query, limit)
+
+        return index.get_search_index().search(query, limit, parent_filter or None)
+
+    def build_in_background(self, space):
+        """Have a worker build the ticket index of a space, at most once per
+        ASSEMBLA_WARM_INTERVAL"""
+        key = 'assembla:index-queued:%s' % space
+        if self.auth is None or not cache.add(key, 1, setting('ASSEMBLA_WARM_INTERVAL', 5 * 60)):
+            return
+
+        from .tasks import warm_space
+        warm_space.delay(auth_id=self.auth.id, space=space)
 
-    def search_users(self, space, query):
+    def search_reports(self, space, query, limit, predicate=None, cancelled=None):
+        """Search the tickets of the configured reports, e.g. active tickets
+        (1) or a custom report id, most recently updated first. Stops as soon
+        as enough tickets are found, or after ASSEMBLA_SEARCH_REPORT_PAGES"""
+        matches = OrderedDict()
+        max_pages = setting('ASSEMBLA_SEARCH_REPORT_PAGES', 5)
+        fetched = 0
+
+        for report in setting('ASSEMBLA_SEARCH_REPORTS', [1]):
+            params = {'report': report, 'sort_by': 'updated_at', 'sort_order': 'desc'}
+            pages = self.iter_matches(space, query, predicate, params, cancelled)
+            for number, (_, found) in enumerate(pages, 1):
+                fetched += 1
+                matches.update((t.id, t) for t in found)
+                if len(matches) >= limit or number >= max_pages:
+                    break
+            if len(matches) >= limit:
+                break
+
+        metrics.timing('search_tickets.pages', fetched, tags={'source': 'report'})
+
+        # rank the tickets found in all pages together
+        return SearchIndex(matches.values(), ('number', 'summary')).search(query, limit)
+
+    def iter_matches(self, space, query, predicate=None, params=None, cancelled=None):
+        """Lazily retrieve the pages of tickets of a space, together with the
+        tickets on each page passing the filter and matching the query. Pages
+        are only retrieved while the caller asks for more, and while 
+        cancelled() returns False"""
+        path = '/spaces/%s/tickets.json' % space
+        for page in self.iter_pages(path, params, project=Ticket):
+            if cancelled is not None and cancelled():
+                raise SearchCancelled()
+            candidates = filters.apply(predicate, page)
+            yield page, SearchIndex(candidates, ('number', 'summary')).search(query)
+
+    @metrics.timed('search_users')
+    def search_users(self, space, query, limit=None):
         """Get a list of all users in a space and filter it"""
-        if (space not in self.users):
-            self.users.update({
-                space: self.get(
-                    '/spaces/%s/users.json' % space,
-                    params={}
-                )
-            })
-            
-        response = self.users[space]
-        
-        query = query.lower()
+        index = self.users.get_or_load(space, lambda: self.load_users(space))
 
-        filtered = [e for e in response if query in e['name'].lower() or query in e['login'].lower()]
-        
-        if setting('ASSEMBLA_USERS_FILTER'):
-            filtered = filter(setting('ASSEMBLA_USERS_FILTER'), filtered)
-            
-        return filtered
+        return index.search(query, limit)
+
+    def get_user(self, user_id):
+        """Get a user by id or login"""
+        return self.get('/users/%s.json' % user_id)
+
+    @classmethod
+    def apply_user(cls, space, user, deleted=False):
+        """Apply a change pushed by Assembla to the cached users of a space,
+        when they are cached"""
+        index = cls.users.get(space)
+        if index is None:
+            return
+
+        users = [u for u in index.documents if u.get('id') != user.get('id')]
+        if not deleted:
+            users.extend(filters.apply(filters.users_filter(), [user]))
+        cls.users.set(space, SearchIndex(users, ('name', 'login')))
+
+    def load_users(self, space):
+        """Get a search index over the name and login of the users in a space
+        passing ASSEMBLA_USERS_FILTER"""
+        return SearchIndex(
+            filters.apply(filters.users_filter(), self.get('/spaces/%s/users.json' % space, params={})),
+            ('name', 'login'),
+        )
@@ -0,0 +1,114 @@
+"""The ticket and user filters configured in ASSEMBLA_*_FILTER settings
+A filter is either a function, or a list of rules every document has to
+match, e.g.:
+
+    ASSEMBLA_TICKET_FILTER = [
+        ('summary', 'istartswith', 'project:'),
+        {'field': 'state', 'op': 'eq', 'value': 1},
+    ]
+
+Filters are compiled once per setting value"""
+from __future__ import absolute_import
+
+import operator
+import six
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from social_auth.utils import setting
+
+
+def lower(value):
+    return six.text_type(value if value is not None else u'').lower()
+
+
+OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': lambda a, b: a is not None and a < b,
+    'lte': lambda a, b: a is not None and a <= b,
+    'gt': lambda a, b: a is not None and a > b,
+    'gte': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'not_in': lambda a, b: a not in b,
+    'contains': lambda a, b: a is not None and b in a,
+    'icontains': lambda a, b: lower(b) in lower(a),
+    'startswith': lambda a, b: a is not None and a.startswith(b),
+    'istartswith': lambda a, b: lower(a).startswith(lower(b)),
+    'isnull': lambda a, b: (a is None) == b,
+}
+
+_compiled = {}
+_lock = threading.Lock()
+
+
+def compile_rule(rule):
+    """Turn a (field, op, value) tuple or dict into a function"""
+    if isinstance(rule, dict):
+        rule = (rule.get('field'), rule.get('op', 'eq'), rule.get('value'))
+    try:
+        field, op, value = rule
+        test = OPERATORS[op]
+    except (KeyError, TypeError, ValueError):
+        raise ImproperlyConfigured('Invalid Assembla filter rule: %r' % (rule,))
+
+    if op in ('in', 'not_in'):
+        value = frozenset(value)
+    return lambda document: test(document.get(field), value)
+
+
+def compile_filter(spec):
+    """Turn a filter function or a list of rules into a single function,
+    or None when nothing is filtered"""
+    if not spec:
+        return None
+    if callable(spec):
+        return spec
+
+    tests = [compile_rule(rule) for rule in spec]
+    if len(tests) == 1:
+        return tests[0]
+    return lambda document: all(test(document) for test in tests)
+
+
+def rule_fields(spec):
+    """The fields used by a list of rules, none for a function"""
+    if not spec or callable(spec):
+        return set()
+    return set(
+        rule.get('field') if isinstance(rule, dict) else rule[0] for rule in spec
+    )
+
+
+def get_filter(name):
+    """Get the compiled filter of a setting, compiling it again only when
+    the setting changed"""
+    spec = setting(name)
+    compiled = _compiled.get(name)
+    if compiled is None or compiled[0] is not spec:
+        compiled = (spec, compile_filter(spec))
+        with _lock:
+            _compiled[name] = compiled
+    return compiled[1]
+
+
+def ticket_filter():
+    """Tickets never searched, left out when the tickets are cached"""
+    return get_filter('ASSEMBLA_TICKET_FILTER')
+
+
+def parent_ticket_filter():
+    """Tickets searched, but never suggested as a parent"""
+    return get_filter('ASSEMBLA_PARENTTICKET_FILTER')
+
+
+def users_filter():
+    """Users left out when the users of a space are cached"""
+    return get_filter('ASSEMBLA_USERS_FILTER')
+
+
+def apply(predicate, documents):
+    """The documents passing the filter"""
+    if predicate is None:
+        return list(documents)
+    return [d for d in documents if predicate(d)]
@@ -0,0 +1,367 @@
+"""Keeps a local copy of the tickets in a space, so autocomplete doesn't
+have to retrieve every ticket from Assembla"""
+from __future__ import absolute_import
+
+import logging
+import time
+import uuid
+import zlib
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from six.moves import cPickle as pickle
+
+from django.core.cache import cache
+from social_auth.utils import setting
+
+from . import filters, metrics
+from .cache import Cache
+from .search import SearchIndex, UpdatedIndex
+
+logger = logging.getLogger('sentry.plugins.assembla')
+
+
+class IndexLocked(Exception):
+    """Another worker held the lock of the ticket index for too long"""
+
+
+_extra_fields = [(), ()]
+
+
+def get_extra_fields():
+    """The fields kept besides Ticket.fields: ASSEMBLA_TICKET_FIELDS and the
+    fields the rules of the ticket filters use"""
+    specs = (
+        setting('ASSEMBLA_TICKET_FIELDS'),
+        setting('ASSEMBLA_TICKET_FILTER'),
+        setting('ASSEMBLA_PARENTTICKET_FILTER'),
+    )
+    known, fields = _extra_fields
+    if len(known) != len(specs) or any(a is not b for a, b in zip(known, specs)):
+        used = set(specs[0] or ()) | filters.rule_fields(specs[1]) | filters.rule_fields(specs[2])
+        fields = tuple(sorted(used - set(Ticket.fields)))
+        _extra_fields[:] = [specs, fields]
+    return fields
+
+
+class Ticket(object):
+    """A ticket, holding only the fields we search and filter on, and the
+    extra fields configured in ASSEMBLA_TICKET_FIELDS
+    Behaves like the ticket dict returned by the API, so the configured
+    filter functions can use it"""
+    fields = (
+        'id', 'number', 'summary', 'status', 'state', 'priority', 
+        'hierarchy_type', 'assigned_to_id', 'reporter_id', 'milestone_id', 
+        'component_id', 'created_on', 'updated_at',
+    )
+    __slots__ = fields + ('extra',)
+
+    def __init__(self, data):
+        for field in self.fields:
+            setattr(self, field, data.get(field))
+        self.extra = dict((f, data.get(f)) for f in get_extra_fields() if f in data)
+
+    def __getitem__(self, field):
+        if field in self.fields:
+            return getattr(self, field)
+        return self.extra[field]
+
+    def get(self, field, default=None):
+        if field in self.fields:
+            return getattr(self, field)
+        return self.extra.get(field, default)
+
+    def __eq__(self, other):
+        return isinstance(other, Ticket) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self.fields) + (self.extra,)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.fields, state):
+            setattr(self, field, value)
+        self.extra = state[len(self.fields)] if len(state) > len(self.fields) else {}
+
+    @classmethod
+    def from_state(cls, state):
+        ticket = cls.__new__(cls)
+        ticket.__setstate__(state)
+        return ticket
+
+
+class TicketIndex(object):
+    """The tickets of a space, stored in Django's cache
+    After the initial build, only tickets updated since the last sync are
+    retrieved. The index expires after ASSEMBLA_INDEX_TIMEOUT, the next
+    build then also drops tickets that were deleted in Assembla. Tickets
+    not passing ASSEMBLA_TICKET_FILTER are left out
+
+    A small state (version and sync times) is kept apart from the tickets,
+    which are stored compressed in chunks of ASSEMBLA_INDEX_CHUNK_SIZE, so
+    no cache value gets near memcached's 1MB limit. The tickets are only
+    loaded when their version changed
+
+    Changes found by a sync or pushed by a webhook are added to the state,
+    until there are more than ASSEMBLA_INDEX_MAX_CHANGES and the tickets
+    are stored as a new version. The state is only changed while holding
+    the lock of the space, changes are not stored when it can't be held"""
+
+    # the search index built per space and version, with the changes since
+    search_indexes = Cache('search-indexes', max_size=20, ttl=24 * 60 * 60, shared=False)
+
+    def __init__(self, client, space):
+        self.client = client
+        self.space = space
+        self.path = '/spaces/%s/tickets.json' % space
+        self.cache_key = 'assembla:ticket-index:%s' % space
+
+    def get_state(self):
+        """Get the state of the cached tickets, syncing first when the last 
+        sync is older than ASSEMBLA_INDEX_SYNC_INTERVAL seconds"""
+        state = cache.get(self.cache_key)
+        metrics.incr('cache.hit' if state is not None else 'cache.miss', tags={'cache': 'ticket-index'})
+        if state is None:
+            state = self.build()
+        elif state['checked_at'] + setting('ASSEMBLA_INDEX_SYNC_INTERVAL', 60) < time.time():
+            state = self.sync(state)
+        return state
+
+    def get_tickets(self, state):
+        """Get the tickets of a state by id, with its changes, None when they
+        were evicted"""
+        if 'tickets' in state:
+            return state['tickets']
+
+        tickets = self.load_chunks(state)
+        if tickets is None:
+            return None
+
+        removed, current = self.get_changes(state)
+        tickets = dict((k, t) for k, t in tickets.items() if not removed(t))
+        tickets.update((t.id, t) for t in current)
+        return tickets
+
+    def get_changes(self, state):
+        """Get a function telling whether a stored ticket was changed since,
+        and the current version of the changed tickets still indexed"""
+        predicate = filters.ticket_filter()
+        ids, numbers = set(), set()
+        current = OrderedDict()
+
+        for values, deleted, _ in state.get('changes', ()):
+            ticket = Ticket.from_state(values)
+            for key, known in list(current.items()):
+                if known.id == ticket.id or (ticket.id is None and known.number == ticket.number):
+                    del current[key]
+            if ticket.id is not None:
+                ids.add(ticket.id)
+            if ticket.number is not None:
+                numbers.add(ticket.number)
+            if not deleted and (predicate is None or predicate(ticket)):
+                current[ticket.id] = ticket
+
+        return lambda t: t.id in ids or t.number in numbers, list(current.values())
+
+    def load_chunks(self, state):
+        """Get the stored tickets of a state by id, without its changes"""
+        keys = self.chunk_keys(state)
+        chunks = cache.get_many(keys)
+        if len(chunks) < len(keys):
+            return None
+
+        tickets = {}
+        for key in keys:
+            for values in pickle.loads(zlib.decompress(chunks[key])):
+                ticket = Ticket.from_state(values)
+                tickets[ticket.id] = ticket
+        return tickets
+
+    def chunk_keys(self, state):
+        return [
+            '%s:%s:%d' % (self.cache_key, state['version'], n) for n in range(state['chunks'])
+        ]
+
+    def is_built(self):
+        """Whether the tickets are cached, the state is only stored after
+        all of their chunks were"""
+        return cache.get(self.cache_key) is not None
+
+    def refresh(self):
+        """Sync the cached tickets now, building them when missing"""
+        state = cache.get(self.cache_key)
+        return self.build() if state is None else self.sync(state)
+
+    def get_search_index(self):
+        """Get a search index over the number and summary of the tickets
+        The index of the stored tickets is kept per version, changes only
+        get a small index of their own"""
+        fields = ('number', 'summary')
+        state = self.get_state()
+        changes = len(state.get('changes', ()))
+
+        version, count, base, index = self.search_indexes.get(self.space, (None, None, None, None))
+        if version is not None and version == state.get('version') and count == changes:
+            return index
+
+        # tickets built but not stored have no version
+        if version is None or version != state.get('version'):
+            tickets = state['tickets'] if 'tickets' in state else self.load_chunks(state)
+            if tickets is None:
+                # replaced by a newer version while reading, or evicted
+                state = cache.get(self.cache_key)
+                tickets = state and self.load_chunks(state)
+                if tickets is None:
+                    state = self.build()
+                    tickets = state['tickets']
+            base = SearchIndex(sorted(tickets.values(), key=lambda t: t.number), fields)
+
+        index = base
+        if state.get('changes'):
+            removed, current = self.get_changes(state)
+            index = UpdatedIndex(base, current, removed, fields)
+
+        self.search_indexes.set(self.space, (
+            state.get('version'), len(state.get('changes', ())), base, index
+        ))
+        return index
+
+    def build(self):
+        """Retrieve all tickets in the space
+        Changes recorded while retrieving them are kept. When the lock can't
+        be held, the tickets are returned without storing them"""
+        started = time.time()
+        tickets = self.client.get_pages(self.path, project=Ticket)
+        tickets = filters.apply(filters.ticket_filter(), tickets)
+        updated = [t.updated_at or '' for t in tickets]
+        state = {
+            'tickets': dict((t.id, t) for t in tickets),
+            'changes': [],
+            'synced_at': max(updated) if updated else '',
+            'checked_at': time.time(),
+            'built_at': time.time(),
+        }
+
+        try:
+            with self.lock():
+                previous = cache.get(self.cache_key) or {}
+                state['changes'] = [c for c in previous.get('changes', ()) if c[2] >= started]
+                if 'version' in previous:
+                    # so store drops the chunks of the version it replaces
+                    state.update(version=previous['version'], chunks=previous['chunks'])
+                return self.store(state)
+        except IndexLocked:
+            return state
+
+    def sync(self, state):
+        """Retrieve the tickets updated since the last sync, newest first,
+        until a page contains a ticket we already have"""
+        params = {'sort_by': 'updated_at', 'sort_order': 'desc'}
+        synced_at = state['synced_at']
+        updated = []
+        pages = 0
+
+        for page in self.client.iter_pages(self.path, params=params, project=Ticket):
+            pages += 1
+            found = [t for t in page if (t.updated_at or '') >= state['synced_at']]
+            updated.extend(found)
+            synced_at = max([synced_at] + [t.updated_at or '' for t in found])
+            if len(found) < len(page):
+                break
+
+        metrics.timing('index.sync.pages', pages)
+        try:
+            return self.record(updated, synced_at=synced_at) or state
+        except IndexLocked:
+            # the next sync retrieves these tickets again
+            return state
+
+    def apply(self, ticket, deleted=False):
+        """Apply a change pushed by Assembla to the cached tickets
+        The last sync time is left alone, so a change missed in between is
+        still picked up by the next sync. Raises IndexLocked when the lock
+        can't be held"""
+        return self.record([ticket], deleted=deleted)
+
+    def record(self, tickets, deleted=False, synced_at=None):
+        """Add changed tickets to the state, skipping the ones recorded
+        already. Returns the new state, None when there is no state. Raises
+        IndexLocked when the lock can't be held"""
+        with self.lock():
+            state = cache.get(self.cache_key)
+            if state is None:
+                return None
+
+            changes = list(state.get('changes', ()))
+            latest = dict((values[0], (values, gone)) for values, gone, _ in changes)
+            for ticket in tickets:
+                values = ticket.__getstate__()
+                if latest.get(ticket.id) != (values, deleted):
+                    changes.append((values, deleted, time.time()))
+                    latest[ticket.id] = (values, deleted)
+
+            state = dict(state, changes=changes)
+            if synced_at is not None:
+                state.update(synced_at=max(state['synced_at'], synced_at), checked_at=time.time())
+
+            if len(changes) > setting('ASSEMBLA_INDEX_MAX_CHANGES', 100):
+                tickets = self.get_tickets(state)
+                if tickets is None:
+                    cache.delete(self.cache_key)
+                    return None
+                state.update(tickets=tickets, changes=[])
+            return self.store(state)
+
+    @contextmanager
+    def lock(self):
+        """Hold the lock of the space, waiting at most 10 seconds for it,
+        raising IndexLocked after that"""
+        key = self.cache_key + ':lock'
+        deadline = time.time() + 10
+        while not cache.add(key, 1, 60):
+            if time.time() >= deadline:
+                logger.warning('assembla.index.lock-timeout', extra={'space': self.space})
+                raise IndexLocked()
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            cache.delete(key)
+
+    def store(self, state):
+        """Cache the state until ASSEMBLA_INDEX_TIMEOUT after the tickets were
+        built. When the state holds tickets, they are stored as a new version
+        Returns the state, holding the tickets when they were passed"""
+        timeout = setting('ASSEMBLA_INDEX_TIMEOUT', 24 * 60 * 60)
+        timeout = int(timeout - (time.time() - state['built_at']))
+        if timeout <= 0:
+            return state
+
+        previous = None
+        if 'tickets' in state:
+            previous = state.get('version') and dict(state)
+            tickets = [t.__getstate__() for t in state['tickets'].values()]
+            size = max(1, int(setting('ASSEMBLA_INDEX_CHUNK_SIZE', 2000)))
+            state['version'] = uuid.uuid4().hex
+            state['chunks'] = (len(tickets) + size - 1) // size
+            keys = self.chunk_keys(state)
+            cache.set_many(dict(
+                (key, zlib.compress(pickle.dumps(tickets[n * size:(n + 1) * size], 2)))
+                for n, key in enumerate(keys)
+            ), timeout)
+
+            # caches like memcached drop values silently, leave the old state
+            if len(cache.get_many(keys)) < len(keys):
+                logger.warning('assembla.index.store-failed', extra={
+                    'space': self.space, 'chunks': len(keys),
+                })
+                cache.delete_many(keys)
+                return state
+
+        cache.set(self.cache_key, dict((k, v) for k, v in state.items() if k != 'tickets'), timeout)
+        if previous is not None and previous['version'] != state['version']:
+            cache.delete_many(self.chunk_keys(previous))
+        return state
@@ -0,0 +1,42 @@
+"""Reports timings and counts through Sentry's metrics, which can be sent to
+statsd or datadog with SENTRY_METRICS_BACKEND"""
+from __future__ import absolute_import
+
+import re
+import time
+
+from functools import wraps
+
+from sentry.utils import metrics
+
+PREFIX = 'sentry-assembla.'
+
+
+def incr(key, amount=1, tags=None):
+    metrics.incr(PREFIX + key, amount=amount, tags=tags)
+
+
+def timing(key, value, tags=None):
+    metrics.timing(PREFIX + key, value, tags=tags)
+
+
+def timed(key):
+    """Decorator reporting how long every call takes"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing(key, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def endpoint(path):
+    """The API endpoint of a path, without space and ticket ids"""
+    path = re.sub(r'^/spaces/[^/]+', '/spaces/:space', path.split('?')[0])
+    path = re.sub(r'/tickets/id/[^/]+', '/tickets/id/:id', path)
+    path = re.sub(r'/tickets/\d+', '/tickets/:number', path)
+    return re.sub(r'\.json$', '', path)
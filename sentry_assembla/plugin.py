@@ -4,19 +4,35 @@ import six
 import logging
 import sentry_assembla
 import os
+import uuid
+
+from datetime import timedelta
 
 from django.conf import settings
+from django.core.cache import cache
 
 from rest_framework.response import Response
 
 from sentry.exceptions import PluginError, PluginIdentityRequired
+from sentry.models import Activity, Event, Group, GroupMeta
+from sentry.models.groupmeta import GroupMetaCacheNotPopulated
 from sentry.plugins.bases.issue2 import IssueTrackingPlugin2, IssueGroupActionEndpoint
 from sentry_plugins.base import CorePluginMixin
+from sentry_plugins.exceptions import ApiError, ApiUnauthorized
 
+from sentry.utils import json
 from sentry.utils.http import absolute_uri
 from social_auth.utils import setting
 
-from .client import AssemblaClient
+from . import metrics
+from .bulk import run_concurrently
+from .cache import Cache
+from .client import AssemblaClient, SearchCancelled
+from .scheduler import BACKGROUND, INTERACTIVE
+from .search import SearchIndex
+from .tokens import ensure_fresh
+from .tasks import associate_issue
+from .utils import parse_spaces
 
 env = os.environ.get
 
@@ -24,6 +40,10 @@ ERR_AUTH_NOT_CONFIGURED = (
     'You still need to associate an Assembla identity with this account.'
 )
 
+ERR_AUTH_EXPIRED = (
+    'Your Assembla identity has expired, please associate it again.'
+)
+
 class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
     description = 'Integrate Assembla issues by linking a repository to a project.'
     slug = 'assembla'
@@ -38,6 +58,13 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
         ('Bug Tracker', author_url + '/sentry-assembla/issues'),
         ('Source', author_url + '/sentry-assembla'),
     ]
+    # spaces per user, default parent tickets per project
+    spaces = Cache('spaces', max_size=1000, ttl=15 * 60)
+    parent_issues = Cache('parent-issues', max_size=1000, ttl=60 * 60)
+    # ready to use clients per user and priority
+    clients = Cache('clients', max_size=1000, ttl=5 * 60, shared=False)
+    # recent autocomplete results per space, field and query
+    autocomplete_results = Cache('autocomplete', max_size=1000, ttl=30, shared=False)
     
     def get_group_urls(self):
         """Adds an extra url to allow for autocompletion in some selects"""
@@ -48,8 +75,18 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
                     plugin=self,
                 )
             ),
+            (
+                r'^bulk', IssueGroupActionEndpoint.as_view(
+                    view_method_name='view_bulk',
+                    plugin=self,
+                )
+            ),
         ]
 
+    def get_url_module(self):
+        """Adds the url Assembla webhooks post to"""
+        return 'sentry_assembla.urls'
+
     def is_configured(self, request, project, **kwargs):
         """Checks whether the option 'space' has been set in the configuration screen"""
         return bool(self.get_option('space', project))
@@ -61,6 +98,47 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
                 return True
         return False
 
+    def get_spaces(self, client):
+        """Get the spaces available to the user of the client"""
+        return self.spaces.get_or_load(
+            client.auth.user_id, lambda: list(client.get_spaces())
+        )
+
+    def get_default_parent_issue(self, client, project):
+        """Get the ticket configured as the default parent, cached by the 
+        configuration, so every worker notices when it is changed"""
+        space = self.get_option('space', project)
+        number = self.get_option('parent_issue_number', project)
+        return self.parent_issues.get_or_load(
+            (project.id, space, number), lambda: client.get_issue_by_number(space, number)
+        )
+
+    def get_search_spaces(self, project):
+        """The space tickets are created in, followed by the other spaces
+        tickets can be linked from"""
+        space = self.get_option('space', project)
+        extra = parse_spaces(self.get_option('extra_spaces', project))
+        return [space] + [s for s in extra if s != space]
+
+    def find_issue(self, client, project, issue_id):
+        """Get a ticket by id, from the space tickets are created in or else
+        from the first other space it is found in. Returns the space too"""
+        spaces = self.get_search_spaces(project)
+        try:
+            return spaces[0], client.get_issue(spaces[0], issue_id)
+        except ApiError as e:
+            if e.code != 404 or len(spaces) == 1:
+                raise
+            not_found = e
+
+        outcomes = run_concurrently(
+            lambda space: client.get_issue(space, issue_id), spaces[1:], concurrency=len(spaces)
+        )
+        for space, (issue, error) in zip(spaces[1:], outcomes):
+            if error is None:
+                return space, issue
+        raise not_found
+
     def get_space_choices(self, spaces):
         """Return the spaces as tuples"""
         return [(w['id'], w['name']) for w in spaces]
@@ -78,14 +156,13 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
         
         client = self.get_client(request.user)
         
-        spaces = client.get_spaces()
+        spaces = self.get_spaces(client)
         space_choices = self.get_space_choices(spaces)
         space = self.get_option('space', group.project)
         if space and not self.has_space_access(space, space_choices):
             space_choices.append((space, space))
 
-        default_parent_issue_number = self.get_option('parent_issue_number', group.project)
-        default_parent_issue = client.get_issue_by_number(space, default_parent_issue_number)
+        default_parent_issue = self.get_default_parent_issue(client, group.project)
 
         default_relationship = self.get_option('relationship', group.project)
                 
@@ -158,13 +235,30 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
             }
         ]
 
-    def get_client(self, user):
-        """Try and setup an API client"""
-        auth = self.get_auth_for_user(user=user)
-        if auth is None:
-            raise PluginIdentityRequired(ERR_AUTH_NOT_CONFIGURED)
-        
-        return AssemblaClient(auth=auth)
+    def get_client(self, user, priority=INTERACTIVE):
+        """Try and setup an API client, reusing the one of the last few 
+        minutes, and making sure its access token can be used. Raises
+        PluginIdentityRequired when the identity has to be associated again,
+        ApiError when its token couldn't be refreshed for now"""
+        client = self.clients.get((user.id, priority))
+        if client is None:
+            auth = self.get_auth_for_user(user=user)
+            if auth is None:
+                raise PluginIdentityRequired(ERR_AUTH_NOT_CONFIGURED)
+            
+            if setting('ASSEMBLA_ASYNC_CLIENT', False) and six.PY3:
+                from .aio import AssemblaClientBridge
+                client = AssemblaClientBridge(auth=auth, priority=priority)
+            else:
+                client = AssemblaClient(auth=auth, priority=priority)
+            self.clients.set((user.id, priority), client)
+
+        try:
+            ensure_fresh(client.auth)
+        except ApiUnauthorized:
+            self.clients.delete((user.id, priority))
+            raise PluginIdentityRequired(ERR_AUTH_EXPIRED)
+        return client
 
     def error_message_from_json(self, data):
         """Convert an Assembla API error to a format Sentry can use"""
@@ -178,30 +272,44 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
             
         return 'unknown error'
 
+    @metrics.timed('plugin.create_issue')
     def create_issue(self, request, group, form_data, **kwargs):
         """Handle a create issue form post"""
         client = self.get_client(request.user)
+        space = self.get_option('space', group.project)
+        
+        # associating the parent can be left to a task, which reports failures
+        defer = bool(setting('ASSEMBLA_DEFER_ASSOCIATIONS', False))
 
         try:
             response = client.create_issue(
-                space=self.get_option('space', group.project), data=form_data
+                space=space, data=form_data, associate=not defer
             )
         except Exception as e:
             self.raise_error(e, identity=client.auth)
 
+        self.store_ticket(group, space, response)
+
+        if defer and form_data.get('parent_issue_id'):
+            associate_issue.delay(
+                auth_id=client.auth.id,
+                space=space,
+                parent_issue_id=form_data['parent_issue_id'],
+                issue_id=response['id'],
+                relationship=form_data.get('relationship'),
+                group_id=group.id,
+                issue_number=response.get('number'),
+            )
+
         return response['id']
     
+    @metrics.timed('plugin.link_issue')
     def link_issue(self, request, group, form_data, **kwargs):
         """Handle a link issue form post"""
         client = self.get_client(request.user)
         
-        space = self.get_option('space', group.project)
-        
         try:
-            issue = client.get_issue(
-                space=space,
-                issue_id=form_data['issue_id'],
-            )
+            space, issue = self.find_issue(client, group.project, form_data['issue_id'])
         except Exception as e:
             self.raise_error(e, identity=client.auth)
 
@@ -211,6 +319,8 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
                 client.create_comment(space, issue, comment)
             except Exception as e:
                 self.raise_error(e, identity=client.auth)
+
+        self.store_ticket(group, space, issue)
                 
         #link_issue is expected to return an issue object containing a 'title'
         #https://github.com/getsentry/sentry/blob/8.22.0/src/sentry/plugins/bases/issue2.py#L278
@@ -218,17 +328,47 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
             'title': issue['summary']
         }
 
+    def store_ticket(self, group, space, issue):
+        """Store the number, summary and status of the ticket of a group, next
+        to the ticket id Sentry stores, so links can be made without the API"""
+        GroupMeta.objects.set_value(group, '%s:ticket' % self.get_conf_key(), json.dumps({
+            'id': issue['id'],
+            'number': issue['number'],
+            'space': space,
+            'summary': issue.get('summary'),
+            'status': issue.get('status'),
+        }))
+
+    def get_ticket(self, group, issue_id):
+        """Get the ticket stored for a group, when it is the ticket with this id"""
+        key = '%s:ticket' % self.get_conf_key()
+        try:
+            value = GroupMeta.objects.get_value(group, key)
+        except GroupMetaCacheNotPopulated:
+            GroupMeta.objects.populate_cache([group])
+            value = GroupMeta.objects.get_value(group, key)
+
+        if not value:
+            return None
+        ticket = json.loads(value)
+        if six.text_type(ticket['id']) != six.text_type(issue_id):
+            return None
+        return ticket
+
     def get_issue_label(self, group, issue_id):
-        """Generate a generic label"""
-        return 'Assembla ticket'
+        """Generate a label using the ticket number, when it was stored"""
+        ticket = self.get_ticket(group, issue_id)
+        if ticket is None:
+            return 'Assembla ticket'
+        return 'Assembla #%s' % ticket['number']
 
     def get_issue_url(self, group, issue_id):
-        """Generate a generic url, v8.22 doesn't allow 
-        storing more values for an issue"""
-        space = self.get_option('space', group.project)
-        
-        # This is a full url actualy, we're missing the url
-        return 'https://app.assembla.com/spaces/%s/tickets' % space
+        """Generate a link to the ticket, when its number was stored. Tickets
+        linked by an earlier version only get a link to the tickets of the space"""
+        ticket = self.get_ticket(group, issue_id)
+        if ticket is None:
+            return 'https://app.assembla.com/spaces/%s/tickets' % self.get_option('space', group.project)
+        return 'https://app.assembla.com/spaces/%s/tickets/%s' % (ticket['space'], ticket['number'])
 
     def validate_config(self, project, config, actor):
         """Validate available config"""
@@ -237,6 +377,12 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
         except ValueError as exc:
             self.logger.exception(six.text_type(exc))
             raise PluginError('Invalid space value')
+
+        if config.get('extra_spaces'):
+            config['extra_spaces'] = ', '.join(parse_spaces(config['extra_spaces']))
+
+        if actor is not None:
+            self.spaces.delete(actor.id)
         return config
 
     def get_config(self, *args, **kwargs):
@@ -244,10 +390,10 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
         user = kwargs['user']
         try:
             client = self.get_client(user)
-        except PluginIdentityRequired as e:
+        except (PluginIdentityRequired, ApiError) as e:
             self.raise_error(e)
             
-        spaces = client.get_spaces()
+        spaces = self.get_spaces(client)
         space_choices = self.get_space_choices(spaces)
         space = self.get_option('space', kwargs['project'])
         
@@ -276,6 +422,13 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
                 'type': 'number',
                 'required': False,
                 'placeholder': '(Optional) Enter a parent ticket number which will be selected by default'
+            }, {
+                'name': 'extra_spaces',
+                'label': 'Also link tickets from these spaces',
+                'type': 'text',
+                'required': False,
+                'placeholder': '(Optional) Space ids, separated by commas',
+                'help': 'Tickets are created in the space above, but can be linked from these spaces as well.'
             }, {
                 'name': 'relationship',
                 'label': 'Default relationship',
@@ -286,30 +439,62 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
             }
         ]
 
+    @metrics.timed('plugin.autocomplete')
     def view_autocomplete(self, request, group, **kwargs):
         """A 'route' to generate select options in the forms"""
         field = request.GET.get('autocomplete_field')
         query = request.GET.get('autocomplete_query')
+        limit = setting('ASSEMBLA_AUTOCOMPLETE_LIMIT', 50)
+        if request.GET.get('autocomplete_limit', '').isdigit():
+            limit = min(limit, int(request.GET['autocomplete_limit'])) or limit
 
-        client = self.get_client(request.user)
+        try:
+            client = self.get_client(request.user)
+        except (PluginIdentityRequired, ApiError) as e:
+            return self.handle_api_error(e)
         space = self.get_option('space', group.project)
         
+        # a newer query of this user for this field cancels this one, a
+        # missing marker (expired, or a cache which doesn't store) doesn't
+        generation_key = 'assembla:autocomplete:%s:%s' % (request.user.id, field)
+        generation = uuid.uuid4().hex
+        cache.set(generation_key, generation, 60)
+        cancelled = lambda: cache.get(generation_key, generation) != generation
+
         results = []
         field_name = field
         if field == 'issue_id' or field == 'parent_issue_id':
-            response = client.search_tickets(
-                space, 
-                query.encode('utf-8'),
-                'parent' if field == 'parent_issue_id' else 'regular'
+            # parent tickets have to be in the space the ticket is created in
+            spaces = self.get_search_spaces(group.project) if field == 'issue_id' else [space]
+            response = self.search_spaces(
+                spaces, query, limit, lambda s: self.search_autocomplete(
+                    s, field, query, limit, cancelled, lambda: client.search_tickets(
+                        s,
+                        query.encode('utf-8'),
+                        'parent' if field == 'parent_issue_id' else 'regular',
+                        limit=limit,
+                        cancelled=cancelled
+                    )
+                )
             )
+            names = {}
+            if len(spaces) > 1:
+                names = dict((s['id'], s['name']) for s in self.get_spaces(client))
             results = [
                 {
-                    'text': '(#%s) %s' % (i['number'], i['summary']),
+                    'text': '(#%s) %s' % (i['number'], i['summary']) if s == space else
+                        '(%s #%s) %s' % (names.get(s, s), i['number'], i['summary']),
                     'id': i['id']
-                } for i in response
+                } for s, i in response
             ]
         elif field == 'assignee':
-            response = client.search_users(space, query.encode('utf-8'))
+            response = self.search_autocomplete(
+                space, field, query, limit, cancelled, lambda: client.search_users(
+                    space,
+                    query.encode('utf-8'),
+                    limit=limit
+                )
+            )
             results = [
                 {
                     'text': '%s (%s)' % (i['name'], i['login']),
@@ -317,7 +502,181 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
                 } for i in response
             ]
         return Response({field: results})
+
+    def search_spaces(self, spaces, query, limit, search):
+        """Run search(space) for each space at the same time, merging the 
+        tickets found in all spaces by rank. Returns (space, ticket) tuples"""
+        if len(spaces) == 1:
+            return [(spaces[0], r) for r in search(spaces[0])]
+
+        outcomes = run_concurrently(search, spaces, concurrency=len(spaces))
+        errors = [error for _, error in outcomes if error is not None]
+        if len(errors) == len(spaces):
+            raise errors[0]
+        for error in errors:
+            self.logger.warning('assembla.search.space-failed', exc_info=error)
+
+        found = [
+            (space, r) for space, (results, _) in zip(spaces, outcomes) for r in results or []
+        ]
+        merged = SearchIndex([r for _, r in found], ('number', 'summary'))
+        return [found[i] for i in merged.positions(query, limit)]
+
+    def search_autocomplete(self, space, field, query, limit, cancelled, search):
+        """Run an autocomplete search, sharing its results
+        Identical queries running at the same time share one search. When an
+        earlier query is a prefix of this one and returned all its matches,
+        this query only has to narrow those down"""
+        fields = ('name', 'login') if field == 'assignee' else ('number', 'summary')
+        query = query.lower()
+
+        for end in range(len(query) - 1, 0, -1):
+            earlier = self.autocomplete_results.get((space, field, limit, query[:end]))
+            if earlier is not None and earlier[0]:
+                return SearchIndex(earlier[1], fields).search(query, limit)
+
+        def load():
+            results = search()
+            return len(results) < limit, results
+
+        while True:
+            try:
+                return self.autocomplete_results.get_or_load((space, field, limit, query), load)[1]
+            except SearchCancelled:
+                if cancelled():
+                    return []
+                # the search we waited for was cancelled, but this one wasn't
     
+    @metrics.timed('plugin.bulk')
+    def view_bulk(self, request, group, **kwargs):
+        """A 'route' to create or link tickets for many groups of the project
+        at once. Posted are an 'action' ('create' or 'link'), the 'groups' and
+        the form data shared by all groups. Groups can also be passed as
+        objects, containing an 'id' and their own form data"""
+        auth_errors = self.check_config_and_auth(request, group)
+        if auth_errors:
+            return Response(auth_errors, status=400)
+
+        action = request.DATA.get('action')
+        if action not in ('create', 'link'):
+            return Response({'error_type': 'validation', 'errors': {'action': 'Invalid action'}}, status=400)
+
+        try:
+            client = self.get_client(request.user, priority=BACKGROUND)
+        except (PluginIdentityRequired, ApiError) as e:
+            return self.handle_api_error(e)
+        space = self.get_option('space', group.project)
+        defaults = dict((k, v) for k, v in request.DATA.items() if k not in ('action', 'groups'))
+
+        items = []
+        for entry in request.DATA.get('groups') or []:
+            form_data = dict(defaults)
+            form_data.update(entry if isinstance(entry, dict) else {'id': entry})
+            items.append((six.text_type(form_data.pop('id', '')), form_data))
+
+        groups = Group.objects.in_bulk([group_id for group_id, _ in items if group_id.isdigit()])
+        groups = dict(
+            (six.text_type(g.id), g) for g in groups.values() if g.project_id == group.project_id
+        )
+
+        # everything touching the database happens here, the threads only call Assembla
+        GroupMeta.objects.populate_cache(list(groups.values()))
+        errors = {}
+        for group_id, form_data in items:
+            g = groups.get(group_id)
+            if g is None:
+                continue
+            try:
+                self.prepare_bulk_item(request, action, g, form_data)
+            except Exception as e:
+                errors[group_id] = e
+
+        def create(item):
+            return space, client.create_issue(space, item[1])
+
+        def link(item):
+            issue_space, issue = self.find_issue(client, group.project, item[1]['issue_id'])
+            if item[1].get('comment'):
+                client.create_comment(issue_space, issue, item[1]['comment'])
+            return issue_space, issue
+
+        known = [item for item in items if item[0] in groups and item[0] not in errors]
+        outcomes = dict(zip(
+            [group_id for group_id, _ in known],
+            run_concurrently(
+                create if action == 'create' else link,
+                known,
+                concurrency=setting('ASSEMBLA_BULK_CONCURRENCY', 4),
+                rate=setting('ASSEMBLA_BULK_RATE', 5),
+            )
+        ))
+
+        results = []
+        for group_id, form_data in items:
+            if group_id in errors:
+                results.append({'group': group_id, 'success': False, 'error': six.text_type(errors[group_id])})
+                continue
+            if group_id not in outcomes:
+                results.append({'group': group_id, 'success': False, 'error': 'Unknown group'})
+                continue
+
+            issue, error = outcomes[group_id]
+            if error is not None:
+                results.append({'group': group_id, 'success': False, 'error': six.text_type(error)})
+                continue
+
+            g = groups[group_id]
+            issue_space, issue = issue
+            title = form_data.get('title') if action == 'create' else issue['summary']
+            self.record_issue(request, g, issue_space, issue, title)
+            results.append({'group': group_id, 'success': True, 'issue_id': issue['id']})
+
+        return Response({'results': results})
+
+    def prepare_bulk_item(self, request, action, group, form_data):
+        """Complete the form data of a group, the title and description of a
+        new ticket default to those of the latest event. Groups which already
+        have a ticket are refused"""
+        if GroupMeta.objects.get_value(group, '%s:tid' % self.get_conf_key(), None):
+            raise PluginError('The issue already has an Assembla ticket')
+
+        if action == 'link':
+            if not form_data.get('issue_id'):
+                raise PluginError('No ticket to link')
+            return
+
+        if form_data.get('title') and 'description' in form_data:
+            return
+
+        event = group.get_latest_event()
+        if event is None:
+            if not form_data.get('title'):
+                raise PluginError('The issue has no events, a title is required')
+            form_data.setdefault('description', '')
+            return
+        Event.objects.bind_nodes([event], 'data')
+        form_data.setdefault('title', self.get_group_title(request, group, event))
+        form_data.setdefault('description', self.get_group_description(request, group, event))
+
+    def record_issue(self, request, group, space, issue, title):
+        """Store the ticket for the group, like creating or linking a single
+        ticket does"""
+        issue_id = issue['id']
+        GroupMeta.objects.set_value(group, '%s:tid' % self.get_conf_key(), issue_id)
+        self.store_ticket(group, space, issue)
+        Activity.objects.create(
+            project=group.project,
+            group=group,
+            type=Activity.CREATE_ISSUE,
+            user=request.user,
+            data={
+                'title': title,
+                'provider': self.get_title(),
+                'location': self.get_issue_url(group, issue_id),
+                'label': self.get_issue_label(group=group, issue_id=issue_id),
+            },
+        )
+
     def setup(self, bindings):
         settings.AUTH_PROVIDERS.update({
             'assembla': ('ASSEMBLA_CLIENT_ID', 'ASSEMBLA_CLIENT_SECRET'),
@@ -342,4 +701,22 @@ class AssemblaPlugin(CorePluginMixin, IssueTrackingPlugin2):
             settings.ASSEMBLA_CLIENT_SECRET = env('ASSEMBLA_CLIENT_SECRET') or None
             
         if setting('ASSEMBLA_CLIENT_ID') == None or setting('ASSEMBLA_CLIENT_SECRET') == None:
-            self.logger.info('Assembla client id or secret not set')
\ No newline at end of file
+            self.logger.info('Assembla client id or secret not set')
+
+        if setting('ASSEMBLA_SERVICE_USER'):
+            settings.CELERYBEAT_SCHEDULE.update({
+                'assembla-warm-spaces': {
+                    'task': 'sentry_assembla.tasks.warm_spaces',
+                    'schedule': timedelta(seconds=setting('ASSEMBLA_WARM_INTERVAL', 5 * 60)),
+                    'options': {'expires': setting('ASSEMBLA_WARM_INTERVAL', 5 * 60)},
+                },
+            })
+
+        if setting('ASSEMBLA_SERVICE_USER') and setting('ASSEMBLA_SYNC_STATUSES', False):
+            settings.CELERYBEAT_SCHEDULE.update({
+                'assembla-sync-statuses': {
+                    'task': 'sentry_assembla.tasks.sync_statuses',
+                    'schedule': timedelta(seconds=setting('ASSEMBLA_STATUS_SYNC_INTERVAL', 5 * 60)),
+                    'options': {'expires': setting('ASSEMBLA_STATUS_SYNC_INTERVAL', 5 * 60)},
+                },
+            })
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""Keeps the calls to the Assembla API within its rate limits
+Every OAuth identity gets a budget of requests, counted in Django's cache so
+all web and Celery workers share it. Background work (syncs, bulk jobs,
+tasks) leaves part of the budget to interactive requests, so autocomplete
+stays fast while a sync is running"""
+from __future__ import absolute_import
+
+import random
+import time
+
+from django.core.cache import cache
+from social_auth.utils import setting
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+
+class Throttled(Exception):
+    """Assembla asked us to back off for longer than ASSEMBLA_MAX_RETRY_DELAY"""
+
+    def __init__(self, seconds):
+        super(Throttled, self).__init__(
+            'Assembla asked to retry after %d seconds' % seconds
+        )
+        self.seconds = seconds
+
+
+class Scheduler(object):
+    """At most `burst` requests per window of burst / rate seconds, paused
+    entirely after Assembla asked us to back off. When the cache can't
+    count, e.g. Django's DummyCache, requests are only held up by pauses"""
+
+    def __init__(self, identity, rate, burst, reserve):
+        self.key = 'assembla:rate:%s' % identity
+        self.burst = max(1, int(burst))
+        self.window = float(self.burst) / rate
+        self.reserve = int(reserve)
+
+    def acquire(self, priority=INTERACTIVE):
+        """Wait until a request may be sent, raising Throttled when paused for
+        longer than ASSEMBLA_MAX_RETRY_DELAY, no request should wait that long"""
+        allowed = self.burst - (self.reserve if priority == BACKGROUND else 0)
+        while True:
+            now = time.time()
+            paused_until = cache.get(self.key + ':paused') or 0
+            if now < paused_until:
+                delay = paused_until - now
+                if delay > setting('ASSEMBLA_MAX_RETRY_DELAY', 30):
+                    raise Throttled(delay)
+            else:
+                window = int(now / self.window)
+                if self.count(window, allowed):
+                    return
+                delay = (window + 1) * self.window - now
+            time.sleep(delay)
+
+    def count(self, window, allowed):
+        """Count a request in a window, unless `allowed` were counted already"""
+        key = '%s:%d' % (self.key, window)
+        if cache.add(key, 1, int(self.window) + 1):
+            return True
+        try:
+            if cache.incr(key) <= allowed:
+                return True
+            cache.decr(key)
+        except ValueError:
+            # the window expired in between
+            return True
+        return False
+
+    def pause(self, seconds):
+        paused_until = max(cache.get(self.key + ':paused') or 0, time.time() + seconds)
+        cache.set(self.key + ':paused', paused_until, int(seconds) + 1)
+
+    def retry_delay(self, status_code, headers, attempt, idempotent):
+        """The number of seconds to wait before retrying a failed request,
+        None when it shouldn't be retried
+        Throttled requests weren't handled, so they can always be retried,
+        server errors only when the request is idempotent. Requests are not
+        retried when Assembla asks to wait longer than ASSEMBLA_MAX_RETRY_DELAY,
+        the following requests then fail right away until that time"""
+        if attempt >= setting('ASSEMBLA_MAX_RETRIES', 3):
+            return None
+        if status_code != 429 and not (idempotent and status_code >= 500):
+            return None
+
+        # full jitter, so throttled workers don't retry in lockstep
+        delay = random.uniform(0, min(30, 0.5 * 2 ** attempt))
+
+        retry_after = headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            self.pause(int(retry_after))
+            if int(retry_after) > setting('ASSEMBLA_MAX_RETRY_DELAY', 30):
+                return None
+            delay = max(delay, int(retry_after))
+        return delay
+
+
+def get_scheduler(identity):
+    """Get the scheduler for an OAuth identity, None for anonymous calls"""
+    if identity is None:
+        return None
+
+    return Scheduler(
+        identity,
+        rate=setting('ASSEMBLA_RATE_LIMIT', 10),
+        burst=setting('ASSEMBLA_RATE_BURST', 20),
+        reserve=setting('ASSEMBLA_INTERACTIVE_RESERVE', 5),
+    )
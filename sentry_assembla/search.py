@@ -0,0 +1,110 @@
+"""In-memory search over tickets and users"""
+from __future__ import absolute_import
+
+import six
+
+
+def combine(*predicates):
+    """Combine the configured filter functions, skipping the ones not set"""
+    predicates = [p for p in predicates if p]
+    if not predicates:
+        return None
+    return lambda document: all(p(document) for p in predicates)
+
+
+class SearchIndex(object):
+    """A trigram index over a few fields of a list of documents
+    Trigrams narrow a query down to a few candidates, which are then matched
+    on substring just like a full scan would. Results are ranked: exact
+    matches first, then prefix matches, then word prefix matches, then
+    any other substring match, keeping the document order otherwise"""
+    gram = 3
+
+    def __init__(self, documents, fields):
+        self.documents = list(documents)
+        self.texts = [
+            u'\n'.join(six.text_type(d.get(f) or u'') for f in fields).lower()
+            for d in self.documents
+        ]
+
+        self.grams = {}
+        for i, text in enumerate(self.texts):
+            for gram in set(self.split(text)):
+                self.grams.setdefault(gram, []).append(i)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def split(self, text):
+        return [text[n:n + self.gram] for n in range(len(text) - self.gram + 1)]
+
+    def candidates(self, query):
+        if len(query) < self.gram:
+            return range(len(self.documents))
+
+        postings = []
+        for gram in set(self.split(query)):
+            if gram not in self.grams:
+                return []
+            postings.append(self.grams[gram])
+        return min(postings, key=len)
+
+    def rank(self, query, text):
+        fields = text.split(u'\n')
+        if query in fields:
+            return 0
+        if any(f.startswith(query) for f in fields):
+            return 1
+        if u' ' + query in text:
+            return 2
+        return 3
+
+    def matches(self, query):
+        """The rank, position and document of the documents containing the
+        lowercase query"""
+        return [
+            (self.rank(query, self.texts[i]), i, self.documents[i])
+            for i in self.candidates(query) if query in self.texts[i]
+        ]
+
+    def ranked(self, query):
+        """The matches of the query, best first"""
+        if isinstance(query, six.binary_type):
+            query = query.decode('utf-8')
+        return sorted(self.matches(query.lower()), key=lambda m: m[:2])
+
+    def positions(self, query, limit=None):
+        """The positions of the documents containing the query, best matches
+        first"""
+        return [i for _, i, _ in self.ranked(query)[:limit]]
+
+    def search(self, query, limit=None, predicate=None):
+        """Find the documents containing the query, best matches first"""
+        results = []
+        for _, _, document in self.ranked(query):
+            if predicate and not predicate(document):
+                continue
+            results.append(document)
+            if limit and len(results) >= limit:
+                break
+        return results
+
+
+class UpdatedIndex(SearchIndex):
+    """A search index with some of its documents changed, without building
+    it again. The changed documents get a small index of their own, their
+    earlier versions are skipped"""
+
+    def __init__(self, base, documents, removed, fields):
+        self.base = base
+        self.removed = removed
+        self.changed = SearchIndex(documents, fields)
+
+    def __len__(self):
+        return len(self.changed) + sum(1 for d in self.base.documents if not self.removed(d))
+
+    def matches(self, query):
+        offset = len(self.base.documents)
+        return [m for m in self.base.matches(query) if not self.removed(m[2])] + [
+            (rank, offset + i, document) for rank, i, document in self.changed.matches(query)
+        ]
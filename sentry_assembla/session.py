@@ -0,0 +1,43 @@
+"""A pooled HTTP session, shared by every call to the Assembla API
+Reusing connections saves a TLS handshake on almost every request"""
+from __future__ import absolute_import
+
+import threading
+
+from requests.adapters import HTTPAdapter
+from sentry.http import build_session
+from social_auth.utils import setting
+
+ASSEMBLA_URL = 'https://api.assembla.com/'
+
+_session = None
+_lock = threading.Lock()
+
+
+def build_adapter():
+    """An HTTP/2 adapter when enabled and hyper is installed, a pooled
+    HTTP/1.1 adapter otherwise"""
+    if setting('ASSEMBLA_HTTP2', False):
+        try:
+            from hyper.contrib import HTTP20Adapter
+        except ImportError:
+            pass
+        else:
+            return HTTP20Adapter()
+
+    size = setting('ASSEMBLA_POOL_SIZE', 10)
+    return HTTPAdapter(pool_connections=size, pool_maxsize=size)
+
+
+def get_session():
+    """Get the session for this process, creating it on first use"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = build_session()
+                session.mount(ASSEMBLA_URL, build_adapter())
+                if not setting('ASSEMBLA_KEEP_ALIVE', True):
+                    session.headers['Connection'] = 'close'
+                _session = session
+    return _session
@@ -8,11 +8,14 @@ from __future__ import absolute_import
 import base64
 import logging
 import requests
+import time
 
 from social_auth.utils import setting
 from social_auth.backends import BaseOAuth2, OAuthBackend
 from social_auth.exceptions import AuthCanceled, AuthUnknownError
 
+from .session import get_session
+
 ASSEMBLA_TOKEN_EXCHANGE_URL = 'https://api.assembla.com/token'
 ASSEMBLA_AUTHORIZATION_URL = 'https://api.assembla.com/authorization'
 ASSEMBLA_USER_DETAILS_URL = 'https://api.assembla.com/v1/user.json'
@@ -29,6 +32,13 @@ class AssemblaBackend(OAuthBackend):
         ('refresh_token', 'refresh_token')
     ]
 
+    def extra_data(self, user, uid, response, details=None):
+        """Store when the access token expires as well"""
+        data = super(AssemblaBackend, self).extra_data(user, uid, response, details)
+        if response.get('expires_in'):
+            data['expires_at'] = int(time.time()) + int(response['expires_in'])
+        return data
+
     def get_user_details(self, response):
         """Return user details from Assembla account"""
 
@@ -52,8 +62,8 @@ class AssemblaAuth(BaseOAuth2):
         """Loads user data from service"""
         headers = {'Authorization': 'Bearer %s' % access_token}
         try:
-            resp = requests.get(ASSEMBLA_USER_DETAILS_URL,
-                                headers=headers)
+            resp = get_session().get(ASSEMBLA_USER_DETAILS_URL,
+                                     headers=headers)
             resp.raise_for_status()
             return resp.json()
         except ValueError:
@@ -73,7 +83,7 @@ class AssemblaAuth(BaseOAuth2):
         params = self.auth_complete_params(self.validate_state())
         headers = self.add_basic_auth_header(self.auth_headers())
         try:
-            response = requests.post(
+            response = get_session().post(
                 self.ACCESS_TOKEN_URL, 
                 data=params,
                 headers=headers
@@ -98,13 +108,12 @@ class AssemblaAuth(BaseOAuth2):
     def refresh_token(cls, token, provider):
         params = cls.refresh_token_params(token, provider)
         headers = cls.add_basic_auth_header(cls.auth_headers())
-        response = requests.post(
+        response = get_session().post(
             cls.ACCESS_TOKEN_URL,
             data=params,
             headers=headers,
         )
         response.raise_for_status()
-        logger.info('repsonse=%s', response.json())
         return response.json()
 
 # Backend definition
@@ -0,0 +1,201 @@
+"""Background tasks, run by Sentry's workers"""
+from __future__ import absolute_import
+
+import logging
+import six
+
+from django.core.cache import cache
+from django.utils import timezone
+from social_auth.models import UserSocialAuth
+from social_auth.utils import setting
+from sentry.models import Activity, Group, GroupMeta, GroupStatus, ProjectOption
+from sentry.tasks.base import instrumented_task
+from sentry.utils import json
+
+from .client import AssemblaClient
+from .index import Ticket, TicketIndex
+from .scheduler import BACKGROUND
+from .utils import parse_spaces
+
+logger = logging.getLogger('sentry.plugins.assembla')
+
+
+@instrumented_task(name='sentry_assembla.tasks.associate_issue')
+def associate_issue(auth_id, space, parent_issue_id, issue_id, relationship=None,
+                    group_id=None, issue_number=None, **kwargs):
+    """Associate a newly created ticket with its parent ticket, noting a
+    failure on the group the ticket was created for"""
+    try:
+        client = AssemblaClient(
+            auth=UserSocialAuth.objects.get(id=auth_id), priority=BACKGROUND
+        )
+        parent_issue = client.get_issue(space, parent_issue_id)
+        client.associate(space, parent_issue, {'id': issue_id}, relationship)
+    except Exception as e:
+        logger.error('assembla.association.failed', exc_info=True, extra={
+            'space': space,
+            'parent_issue_id': parent_issue_id,
+            'issue_id': issue_id,
+        })
+        group = group_id and Group.objects.filter(id=group_id).first()
+        if group:
+            Activity.objects.create(
+                project_id=group.project_id,
+                group=group,
+                type=Activity.NOTE,
+                data={'text': u'Assembla ticket %s could not be associated with its parent ticket: %s' % (
+                    '#%s' % issue_number if issue_number else issue_id, six.text_type(e)
+                )},
+            )
+
+
+def get_service_auth():
+    """Get the Assembla identity of ASSEMBLA_SERVICE_USER, a Sentry username"""
+    username = setting('ASSEMBLA_SERVICE_USER')
+    if not username:
+        return None
+
+    return UserSocialAuth.objects.filter(
+        provider='assembla', user__username=username
+    ).first()
+
+
+@instrumented_task(name='sentry_assembla.tasks.warm_spaces')
+def warm_spaces(**kwargs):
+    """Refresh the tickets and users of every configured space, run 
+    periodically so autocomplete never has to wait for them"""
+    auth = get_service_auth()
+    if auth is None:
+        logger.info('assembla.warm.no-service-user')
+        return
+
+    for space in get_spaces():
+        warm_space.delay(auth_id=auth.id, space=space)
+
+
+@instrumented_task(name='sentry_assembla.tasks.warm_space')
+def warm_space(auth_id, space, **kwargs):
+    """Refresh the tickets and users of a space, unless another worker
+    already is"""
+    lock = 'assembla:warm-lock:%s' % space
+    if not cache.add(lock, 1, setting('ASSEMBLA_WARM_INTERVAL', 5 * 60)):
+        return
+
+    try:
+        client = AssemblaClient(
+            auth=UserSocialAuth.objects.get(id=auth_id), priority=BACKGROUND
+        )
+        TicketIndex(client, space).refresh()
+        client.users.set(space, client.load_users(space))
+    except Exception:
+        logger.error('assembla.warm.failed', exc_info=True, extra={'space': space})
+    finally:
+        cache.delete(lock)
+
+
+def get_spaces():
+    """Get the spaces configured for any project, searched ones included"""
+    options = ProjectOption.objects.filter(key__in=('assembla:space', 'assembla:extra_spaces'))
+    spaces = set()
+    for option in options:
+        if option.key == 'assembla:space' and option.value:
+            spaces.add(option.value)
+        elif option.key == 'assembla:extra_spaces':
+            spaces.update(parse_spaces(option.value))
+    return spaces
+
+
+@instrumented_task(name='sentry_assembla.tasks.sync_statuses')
+def sync_statuses(**kwargs):
+    """Reflect the status of linked tickets in their groups, run periodically"""
+    auth = get_service_auth()
+    if auth is None:
+        logger.info('assembla.status-sync.no-service-user')
+        return
+
+    for space in get_spaces():
+        sync_space_statuses.delay(auth_id=auth.id, space=space)
+
+
+@instrumented_task(name='sentry_assembla.tasks.sync_space_statuses')
+def sync_space_statuses(auth_id, space, **kwargs):
+    """Retrieve the tickets of a space updated since the last sync, newest
+    first, and update the groups linked to them. The first sync only looks
+    at the first page"""
+    lock = 'assembla:status-sync-lock:%s' % space
+    if not cache.add(lock, 1, setting('ASSEMBLA_STATUS_SYNC_INTERVAL', 5 * 60)):
+        return
+
+    try:
+        client = AssemblaClient(
+            auth=UserSocialAuth.objects.get(id=auth_id), priority=BACKGROUND
+        )
+        key = 'assembla:status-synced-at:%s' % space
+        synced_at = cache.get(key)
+        params = {'sort_by': 'updated_at', 'sort_order': 'desc'}
+
+        changed = {}
+        newest = synced_at or ''
+        path = '/spaces/%s/tickets.json' % space
+        for page in client.iter_pages(path, params=params, project=Ticket):
+            updated = [t for t in page if (t.updated_at or '') >= (synced_at or '')]
+            for ticket in updated:
+                changed.setdefault(six.text_type(ticket.id), ticket)
+                newest = max(newest, ticket.updated_at or '')
+            if synced_at is None or len(updated) < len(page):
+                break
+
+        if changed:
+            update_groups(space, changed)
+        cache.set(key, newest, 30 * 24 * 60 * 60)
+    except Exception:
+        logger.error('assembla.status-sync.failed', exc_info=True, extra={'space': space})
+    finally:
+        cache.delete(lock)
+
+
+def is_resolved(ticket):
+    """Whether a ticket resolves its groups, by ASSEMBLA_RESOLVE_STATUSES
+    (e.g. ['Fixed', 'Invalid']) or when the ticket is closed"""
+    statuses = setting('ASSEMBLA_RESOLVE_STATUSES')
+    if statuses:
+        return ticket.status in statuses
+    return ticket.state == 0
+
+
+def update_groups(space, tickets):
+    """Store the status of the changed tickets for their groups, and resolve
+    the unresolved groups of resolved tickets"""
+    linked = GroupMeta.objects.filter(
+        key='assembla:tid', value__in=list(tickets.keys())
+    ).values_list('group_id', 'value')
+    if not linked:
+        return
+
+    groups = Group.objects.in_bulk([group_id for group_id, _ in linked])
+    for group_id, ticket_id in linked:
+        group = groups.get(group_id)
+        ticket = tickets[ticket_id]
+        if group is None:
+            continue
+
+        GroupMeta.objects.set_value(group, 'assembla:ticket', json.dumps({
+            'id': ticket.id,
+            'number': ticket.number,
+            'space': space,
+            'summary': ticket.summary,
+            'status': ticket.status,
+        }))
+
+        if group.status != GroupStatus.UNRESOLVED or not is_resolved(ticket):
+            continue
+        resolved = Group.objects.filter(id=group.id, status=GroupStatus.UNRESOLVED).update(
+            status=GroupStatus.RESOLVED, resolved_at=timezone.now(),
+        )
+        if resolved:
+            Activity.objects.create(
+                project_id=group.project_id,
+                group=group,
+                type=Activity.SET_RESOLVED,
+                data={'provider': 'Assembla', 'ticket': ticket.number, 'status': ticket.status},
+            )
@@ -0,0 +1,86 @@
+"""Keeps OAuth access tokens fresh
+Assembla access tokens expire after a short while. Instead of finding out
+through a failed request, tokens about to expire are refreshed in the 
+background, tokens which already expired right away. Either way, only once
+per identity at a time"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from django.db import connection
+from requests.exceptions import HTTPError, RequestException
+from social_auth.utils import setting
+from sentry_plugins.exceptions import ApiError, ApiHostError, ApiUnauthorized
+
+from .cache import Cache
+from .social_auth import AssemblaAuth
+
+logger = logging.getLogger('sentry.plugins.assembla')
+
+# the refreshed tokens per identity, so concurrent refreshes share one
+refreshes = Cache('token-refreshes', max_size=1000, ttl=10, shared=False)
+
+_background = set()
+_lock = threading.Lock()
+
+
+def refresh(auth):
+    """Refresh the access token of an identity now, raising ApiUnauthorized
+    when Assembla refuses, e.g. because access was revoked. When Assembla
+    can't be reached, or fails, ApiHostError or ApiError is raised"""
+    def load():
+        try:
+            response = AssemblaAuth.refresh_token(auth.extra_data['refresh_token'], auth.provider)
+        except HTTPError as e:
+            if e.response.status_code not in (400, 401):
+                raise ApiError.from_response(e.response)
+            logger.info('assembla.token.refresh-refused', exc_info=True, extra={'auth_id': auth.id})
+            raise ApiUnauthorized(u'The Assembla access token could not be refreshed: %s' % e)
+        except RequestException as e:
+            raise ApiHostError.from_exception(e)
+        auth.extra_data.update({
+            'access_token': response['access_token'],
+            'refresh_token': response.get('refresh_token') or auth.extra_data['refresh_token'],
+            'expires_at': int(time.time()) + int(response['expires_in'])
+                if response.get('expires_in') else None,
+        })
+        auth.save()
+        return dict(auth.extra_data)
+
+    auth.extra_data.update(refreshes.get_or_load(auth.id, load))
+
+
+def refresh_in_background(auth):
+    with _lock:
+        if auth.id in _background:
+            return
+        _background.add(auth.id)
+
+    def run():
+        try:
+            refresh(auth)
+        except Exception:
+            logger.warning('assembla.token.refresh-failed', exc_info=True, extra={'auth_id': auth.id})
+        finally:
+            with _lock:
+                _background.discard(auth.id)
+            connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
+def ensure_fresh(auth):
+    """Make sure the access token can be used, refreshing it when it expires
+    within ASSEMBLA_TOKEN_REFRESH_MARGIN seconds"""
+    if not auth.extra_data.get('expires_at') or not auth.extra_data.get('refresh_token'):
+        return
+
+    remaining = auth.extra_data['expires_at'] - time.time()
+    if remaining <= 0:
+        refresh(auth)
+    elif remaining < setting('ASSEMBLA_TOKEN_REFRESH_MARGIN', 60):
+        refresh_in_background(auth)
@@ -0,0 +1,10 @@
+from __future__ import absolute_import
+
+from django.conf.urls import patterns, url
+
+from .webhooks import WebhookView
+
+urlpatterns = patterns(
+    '',
+    url(r'^webhook/$', WebhookView.as_view()),
+)
@@ -0,0 +1,7 @@
+"""Helpers shared by the plugin and its tasks"""
+from __future__ import absolute_import
+
+
+def parse_spaces(value):
+    """Split the 'extra_spaces' option, space ids separated by commas"""
+    return [s.strip() for s in (value or '').replace('\n', ',').split(',') if s.strip()]
@@ -0,0 +1,93 @@
+"""Receives ticket and user changes pushed by Assembla webhooks"""
+from __future__ import absolute_import
+
+import logging
+
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import View
+from social_auth.utils import setting
+from sentry.utils import json
+
+from .client import AssemblaClient
+from .index import IndexLocked, Ticket, TicketIndex
+from .scheduler import BACKGROUND
+from .tasks import get_service_auth
+
+logger = logging.getLogger('sentry.plugins.assembla')
+
+
+class WebhookView(View):
+    """Applies changes to the cached tickets and users of a space
+    Assembla posts the content configured for the webhook, which should be:
+
+        {"space": "<space id>", "object": "ticket" or "user",
+         "action": "created", "updated" or "deleted",
+         "ticket": {"id": ..., "number": ..., "summary": ...},
+         "user": {"id": ..., "login": ..., "name": ...}}
+
+    Assembla doesn't sign its webhooks, the url must contain the secret set
+    in ASSEMBLA_WEBHOOK_SECRET instead: /plugins/assembla/webhook/?secret=..."""
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'POST':
+            return HttpResponse(status=405)
+        return super(WebhookView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        secret = setting('ASSEMBLA_WEBHOOK_SECRET')
+        if not secret or not constant_time_compare(request.GET.get('secret') or '', secret):
+            return HttpResponse(status=403)
+
+        try:
+            event = json.loads(request.body)
+            space = event['space']
+        except (ValueError, KeyError, TypeError):
+            return HttpResponse(status=400)
+
+        deleted = event.get('action') == 'deleted'
+        if event.get('object') == 'user':
+            return self.apply_user(space, event.get('user') or {}, deleted)
+
+        ticket = Ticket(event.get('ticket') or {})
+        if ticket.id is None and ticket.number is None:
+            return HttpResponse(status=400)
+
+        if not deleted and (ticket.id is None or ticket.summary is None):
+            # the webhook only told us which ticket changed
+            auth = get_service_auth()
+            if auth is None:
+                logger.info('assembla.webhook.no-service-user')
+                return HttpResponse(status=202)
+
+            client = AssemblaClient(auth=auth, priority=BACKGROUND)
+            if ticket.number is not None:
+                ticket = Ticket(client.get_issue_by_number(space, ticket.number))
+            else:
+                ticket = Ticket(client.get_issue(space, ticket.id))
+
+        try:
+            TicketIndex(None, space).apply(ticket, deleted=deleted)
+        except IndexLocked:
+            # the next sync picks the change up as well
+            return HttpResponse(status=503)
+        return HttpResponse(status=204)
+
+    def apply_user(self, space, user, deleted):
+        if user.get('id') is None:
+            return HttpResponse(status=400)
+
+        if not deleted and (user.get('name') is None or user.get('login') is None):
+            # the webhook only told us which user changed
+            auth = get_service_auth()
+            if auth is None:
+                # users are few, simply load them again when needed
+                AssemblaClient.users.delete(space)
+                return HttpResponse(status=204)
+            user = AssemblaClient(auth=auth, priority=BACKGROUND).get_user(user['id'])
+
+        AssemblaClient.apply_user(space, user, deleted=deleted)
+        return HttpResponse(status=204)
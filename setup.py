@@ -1,7 +1,20 @@
 # coding=utf-8
 """This module installs the Sentry.io Assembla integration plugin"""
+import sys
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+
+
+class BuildPy(build_py):
+    """Leaves out the asyncio client on Python 2, it can't be compiled there"""
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info[0] < 3:
+            modules = [m for m in modules if m[:2] != ('sentry_assembla', 'aio')]
+        return modules
+
 
 setup(
     name='sentry_assembla',
@@ -12,7 +25,12 @@ setup(
     keywords='sentry-assembla sentry assembla',
     long_description=open('README.md').read(),
     packages=find_packages(),
+    cmdclass={'build_py': BuildPy},
     dependency_links=[],
+    extras_require={
+        'async': ['aiohttp'],
+        'streaming': ['ijson'],
+    },
     license='MIT',
     include_package_data=True,
     entry_points={